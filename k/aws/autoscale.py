@@ -2,12 +2,13 @@ import os
 import time
 import boto
 import boto.exception
-import boto.ec2.autoscale
 import k.aws.util
 import functools
-from k.aws.config import AwsCreds, connection_hash
+from k.aws.config import AwsCreds, connection_hash, register_connection
 from k.aws.config import RegionAwsCreds, region_connection_hash
+from k.aws.connections import pooled
 
+@pooled("autoscale")
 def connect(creds):
 	"""
 	Connect to autoscale, with user-provided options.
@@ -18,10 +19,12 @@ def connect(creds):
 	:rtype: boto.ec2.autoscale.AutoScaleConnection
 	"""
 	if isinstance(creds, AwsCreds):
-		return boto.connect_autoscale(**connection_hash(creds))
+		return register_connection(creds,
+			boto.connect_autoscale(**connection_hash(creds)))
 	elif isinstance(creds, RegionAwsCreds):
-		return boto.ec2.autoscale.connect_to_region(
-			**region_connection_hash(creds))
+		from boto.ec2.autoscale import connect_to_region
+		return register_connection(creds,
+			connect_to_region(**region_connection_hash(creds)))
 	raise Exception("Unrecognized credential type: %s" % creds)
 
 def get_autoscale_options(parser):
@@ -2,12 +2,13 @@ import os
 import time
 import boto
 import boto.exception
-import boto.cloudformation
 import k.aws.util
 import functools
-from k.aws.config import AwsCreds, connection_hash
+from k.aws.config import AwsCreds, connection_hash, register_connection
 from k.aws.config import RegionAwsCreds, region_connection_hash
+from k.aws.connections import pooled
 
+@pooled("cfn")
 def connect(creds):
 	"""
 	Connect to cloudformation, with user-provided options.
@@ -19,10 +20,12 @@ def connect(creds):
 
 	Note: IAM cannot authenticate a user using STS credentials."""
 	if isinstance(creds, AwsCreds):
-		return boto.connect_cloudformation(**connection_hash(creds))
+		return register_connection(creds,
+			boto.connect_cloudformation(**connection_hash(creds)))
 	elif isinstance(creds, RegionAwsCreds):
-		return boto.cloudformation.connect_to_region(
-			**region_connection_hash(creds))
+		from boto.cloudformation import connect_to_region
+		return register_connection(creds,
+			connect_to_region(**region_connection_hash(creds)))
 	raise Exception("Unrecognized credential type: %s" % creds)
 
 def get_cfn_options(parser):
@@ -48,6 +48,14 @@ If obj.forcefile is set to True:
    a variety of locations: ~/.aws/*-conf, ~/aws/*.conf,
    /etc/knewton/configurations/aws/*.yml, ~/.k.aws/*.yml
 
+If obj.forceiam is set to True and there is no environment:
+
+ - get_keys() will use the keys of the instance's IAM role.  They are
+   cached in ~/.k.aws/<role>-rw/keys.yml, which every process on the
+   box shares, and refreshed in the background before they expire;
+   connections made with the connect() functions of k.aws are switched
+   over to the new keys as they come in.
+
 In both cases, the collections.namedtuple 'AwsCreds' will be returned,
 which consists of the following fields:
 ('access', 'secret', 'token', 'mode', 'env', 'privatekey', 'cert')
@@ -82,7 +90,7 @@ the time this is being written (Aug 6, 2012).
 """
 
 
-import ConfigParser
+import fcntl
 import logging
 import os
 import os.path
@@ -91,9 +99,10 @@ import glob
 import json
 import datetime
 import re
+import threading
+import time
 import types
-import yaml
-import requests
+import weakref
 from collections import namedtuple
 from k.stdlib.collections import defaultnamedtuple
 
@@ -102,6 +111,14 @@ AWS_PATH = '/etc/knewton/configuration/aws'
 K_AWS_PATH = os.path.expanduser('~/.k.aws')
 DEFAULT_REGION_NAME = 'us-east-1'
 OUTPUT_FORMATS = ['json', 'tsv', 'text']
+# yaml files in the config directories that aren't environments
+NOT_ENVIRONMENTS = ['tools', 'keypairs']
+METADATA_URL = "http://169.254.169.254/latest/meta-data/iam/security-credentials/"
+METADATA_TIMEOUT = 1
+# Temporary keys are refreshed this many seconds before they expire, and
+# a failed refresh is retried every REFRESH_RETRY seconds
+REFRESH_MARGIN = 15 * 60
+REFRESH_RETRY = 60
 
 AwsCreds = defaultnamedtuple(
 	'AwsCreds',
@@ -132,34 +149,90 @@ def region_connection_hash(region_creds):
 		'security_token': region_creds.creds.token
 	}
 
-def get_box_iam_keys(account, timeout=0.1):
-	"""Try to load keys from the instance IAM role"""
-	url = "http://169.254.169.254/latest/meta-data/iam/security-credentials/{0}".format(account)
+# yaml, requests and ConfigParser are only imported when they're needed,
+# since they take longer to import than most command line tools take
+# to run otherwise
+
+def _yaml_loader():
+	"""libyaml's loader, which is many times faster, where it's been built"""
+	import yaml
+	return getattr(yaml, 'CLoader', yaml.Loader)
+
+def get_box_iam_role(timeout=METADATA_TIMEOUT):
+	"""The name of the instance's IAM role, or None if it hasn't got one"""
+	import requests
+	try:
+		response = requests.get(METADATA_URL, timeout=timeout)
+	except (requests.ConnectionError, requests.Timeout):
+		return None
+	if response.status_code != 200:
+		return None
+	roles = response.content.split()
+	if not roles:
+		return None
+	return roles[0]
+
+def _fetch_box_iam_keys(account, timeout=METADATA_TIMEOUT):
+	"""Get the keys of the instance IAM role from the metadata service"""
+	import requests
+	url = METADATA_URL + account
 	try:
 		keys = json.loads(requests.get(url, timeout=timeout).content)
 		keys['accessKeyId']     = keys['AccessKeyId']
-		keys['secretAccessKey'] = keys['SecretAccessKeyId']
+		keys['secretAccessKey'] = keys['SecretAccessKey']
 		keys['expiration']      = keys['Expiration']
 		keys['sessionToken']    = keys['Token']
-		# the access is actually provided by the IAM role, so
-		# the access mode isn't relevent
-		return _generate_cache(account, "rw", keys)
-	except ValueError:
+		return keys
+	except (ValueError, KeyError):
 		return None
 	except requests.ConnectionError:
 		return None
 	except requests.Timeout:
 		return None
 
-def _generate_cache(account, access, keys):
-	"""Generates an on-disk cache of the time-limited keys that've
-	been obtained, so it can be re-used without extra expensive calls
-	"""
+def get_box_iam_keys(account, timeout=0.1):
+	"""Try to load keys from the instance IAM role"""
+	# the access is actually provided by the IAM role, so
+	# the access mode isn't relevent
+	return _get_cached_keys(account, "rw",
+		lambda: _fetch_box_iam_keys(account, timeout))
+
+def _cache_dir(account, access):
 	if not os.path.exists(K_AWS_PATH):
 		os.mkdir(K_AWS_PATH, 0700)
 	env_dir = os.path.join(K_AWS_PATH, "%s-%s" % (account, access))
 	if not os.path.exists(env_dir):
 		os.mkdir(env_dir, 0700)
+	return env_dir
+
+def _get_cached_keys(account, access, fetch, margin=0):
+	"""Use the on-disk cache of time-limited keys if it's good for at
+	least margin more seconds, or else fetch() new keys and cache them.
+	The cache is locked throughout, so that of many processes starting
+	at once only one fetches keys, and the others use its cache.
+	"""
+	lock_path = os.path.join(_cache_dir(account, access), "keys.lock")
+	fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0600)
+	try:
+		fcntl.flock(fd, fcntl.LOCK_EX)
+		cache = _load_cache(account, access)
+		if cache and _is_cache_valid(cache, margin):
+			return cache
+		keys = fetch()
+		if not keys:
+			return None
+		return _generate_cache(account, access, keys)
+	finally:
+		os.close(fd)
+
+def _generate_cache(account, access, keys):
+	"""Generates an on-disk cache of the time-limited keys that've
+	been obtained, so it can be re-used without extra expensive calls.
+	The cache is written to a temp file which is renamed into place, so
+	readers never see half of it.
+	"""
+	import yaml
+	env_dir = _cache_dir(account, access)
 	cache = {
 		'access': keys['accessKeyId'],
 		'secret': keys['secretAccessKey'],
@@ -169,8 +242,11 @@ def _generate_cache(account, access, keys):
 		'readmode': access
 	}
 	filename = os.path.join(env_dir, "keys.yml")
-	with open(filename, "w") as yaml_file:
+	tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+	fd = os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+	with os.fdopen(fd, "w") as yaml_file:
 		yaml_file.write(yaml.dump(cache))
+	os.rename(tmp_filename, filename)
 	return cache
 
 def _load_cache(account, access):
@@ -181,27 +257,184 @@ def _load_cache(account, access):
 	filename = os.path.join(env_dir, "keys.yml")
 	if not os.path.exists(filename):
 		return
+	import yaml
 	with open(filename) as yaml_file:
-		cache = yaml.load(yaml_file)
+		cache = yaml.load(yaml_file, Loader=_yaml_loader())
 	logging.info('_load_cache: loading STS cache from {0}'.format(filename))
 	return cache
 
-def _is_cache_valid(cache):
-	"""Checks to see whether the cache has endured beyond its useful
-	lifespan
-	"""
+def _cache_expiration(cache):
+	"""The (utc) datetime the cached keys expire at"""
 	try:
-		cache_time = datetime.datetime.strptime(
+		return datetime.datetime.strptime(
 			cache['expiration'], '%Y-%m-%dT%H:%M:%S.%fZ')
 	except ValueError:
 		# The values that amazon returns may have changed?
-		cache_time = datetime.datetime.strptime(
+		return datetime.datetime.strptime(
 			cache['expiration'], '%Y-%m-%dT%H:%M:%SZ')
-	if datetime.datetime.utcnow() < cache_time:
+
+def _is_cache_valid(cache, margin=0):
+	"""Checks to see whether the cache has endured beyond its useful
+	lifespan, or will within margin seconds
+	"""
+	cache_time = _cache_expiration(cache)
+	if datetime.datetime.utcnow() + datetime.timedelta(seconds=margin) < cache_time:
 		return True
 	logging.info('_is_cache_valid: STS cache has expired')
 	return False
 
+# Providers by (account, access), and the provider that issued each
+# access key, so that connections made with its keys can be updated
+_providers = {}
+_issued = {}
+_providers_lock = threading.Lock()
+# (role,) once the instance's IAM role has been looked up, even if it
+# hasn't got one, so that only the first lookup waits on the metadata
+# service
+_box_iam_role = None
+
+def _update_connection(conn, cache):
+	"""Switch a boto connection over to new keys"""
+	provider = getattr(conn, 'provider', None)
+	if provider is None:
+		return
+	provider.access_key = cache['access']
+	provider.secret_key = cache['secret']
+	provider.security_token = cache['token']
+	handler = getattr(conn, '_auth_handler', None)
+	if handler is not None and hasattr(handler, 'update_provider'):
+		handler.update_provider(provider)
+
+class CredentialProvider(object):
+	"""Serves time-limited keys (an instance role's, or from STS), from
+	the on-disk cache that's shared by every process.  Once they've been
+	handed out, a background thread refreshes them REFRESH_MARGIN seconds
+	before they expire, and switches every connection registered with
+	the provider over to the new keys, so that long-running processes
+	don't need restarting.  fetch() gets new keys, as a dict with
+	accessKeyId, secretAccessKey, sessionToken and expiration.
+	"""
+	def __init__(self, account, access, fetch, margin=REFRESH_MARGIN):
+		self.account = account
+		self.access = access
+		self.fetch = fetch
+		self.margin = margin
+		self.cache = None
+		self.lock = threading.RLock()
+		self.connections = weakref.WeakSet()
+		self.thread = None
+		self.pid = None
+
+	def refresh(self, margin=0):
+		"""The cached keys, refreshed if they're good for less than margin
+		more seconds.  Returns None if there are none to be had."""
+		with self.lock:
+			if self.cache and _is_cache_valid(self.cache, margin):
+				return self.cache
+			cache = _get_cached_keys(self.account, self.access, self.fetch,
+				margin)
+			if cache is None:
+				return self.cache
+			if self.cache is None or cache['access'] != self.cache['access'] or (
+					cache['token'] != self.cache['token']):
+				logging.info('CredentialProvider: new keys for {0}, expiring {1}'.format(
+					self.account, cache['expiration']))
+				for conn in list(self.connections):
+					_update_connection(conn, cache)
+			self.cache = cache
+			_issued[cache['access']] = self
+			return cache
+
+	def get(self):
+		"""The current keys, as AwsCreds, or None"""
+		cache = self.refresh()
+		if cache is None:
+			return None
+		self._start()
+		return AwsCreds(cache['access'], cache['secret'], cache['token'],
+			cache['readmode'], self.account)
+
+	def register(self, conn):
+		"""Keep conn's keys up to date.  Returns conn."""
+		with self.lock:
+			self.connections.add(conn)
+		self._start()
+		return conn
+
+	def _start(self):
+		# The thread doesn't survive a fork, so a child process gets one of
+		# its own
+		with self.lock:
+			if self.pid == os.getpid() and self.thread.is_alive():
+				return
+			self.pid = os.getpid()
+			self.thread = threading.Thread(target=self._run,
+				name="refresh-{0}".format(self.account))
+			self.thread.daemon = True
+			self.thread.start()
+
+	def _delay(self):
+		"""Seconds until the keys should be refreshed"""
+		if self.cache is None:
+			return REFRESH_RETRY
+		left = _cache_expiration(self.cache) - datetime.datetime.utcnow()
+		seconds = left.days * 86400 + left.seconds - self.margin
+		return max(REFRESH_RETRY, seconds)
+
+	def _run(self):
+		while True:
+			time.sleep(self._delay())
+			try:
+				self.refresh(self.margin)
+			except Exception:
+				logging.exception('CredentialProvider: refreshing keys for {0} failed'.format(
+					self.account))
+
+def get_credential_provider(account=None, access="rw", fetch=None):
+	"""The process-wide CredentialProvider of an account's keys.  By
+	default, these are the keys of the instance's IAM role (the account
+	defaulting to the role's name); returns None if there isn't one.
+	"""
+	global _box_iam_role
+	if account is None:
+		if _box_iam_role is None:
+			_box_iam_role = (get_box_iam_role(),)
+		account = _box_iam_role[0]
+		if account is None:
+			return None
+	with _providers_lock:
+		provider = _providers.get((account, access))
+		if provider is None:
+			if fetch is None:
+				fetch = lambda: _fetch_box_iam_keys(account)
+			provider = CredentialProvider(account, access, fetch)
+			_providers[(account, access)] = provider
+		return provider
+
+def sts_session_fetcher(creds, duration=3600):
+	"""A CredentialProvider fetch function that gets session keys from
+	STS with long-lived creds."""
+	import boto.sts
+	def fetch():
+		sts = boto.sts.STSConnection(**connection_hash(creds))
+		session = sts.get_session_token(duration=duration)
+		return {
+			'accessKeyId': session.access_key,
+			'secretAccessKey': session.secret_key,
+			'sessionToken': session.session_token,
+			'expiration': session.expiration,
+		}
+	return fetch
+
+def register_connection(creds, conn):
+	"""Have the CredentialProvider that issued creds, if any, keep the
+	connection's keys up to date.  Returns conn."""
+	creds = getattr(creds, 'creds', creds)
+	provider = _issued.get(getattr(creds, 'access', None))
+	if provider is not None:
+		provider.register(conn)
+	return conn
+
 def get_region_keys(options):
 	"""
 	Extract the region name and credentials, from the options.
@@ -237,26 +470,26 @@ def _get_creds_from_environment_yaml(env):
 		logging.info('_get_creds_from_environment_yaml: env was not specified')
 		return None
 
-	aws_conf = _parse_aws_confs()
-	if env not in aws_conf:
+	aws_conf = _get_aws_conf(env)
+	if aws_conf is None:
 		logging.info('_get_creds_from_environment_yaml: {0} is not amongst the yaml'
 				' config files'.format(env))
 		return None
 
 	token = None
 	readmode = None
-	access = aws_conf[env]['access_key']
-	secret = aws_conf[env]['secret_key']
+	access = aws_conf['access_key']
+	secret = aws_conf['secret_key']
 	if not (access and secret):
 		logging.info('_get_creds_from_environment_yaml: either access or secret was not specified')
 		return None
 
-	privatekey = aws_conf[env].get('private_key')
+	privatekey = aws_conf.get('private_key')
 	if privatekey:
 		if not os.path.exists(privatekey):
 			privatekey = None
 
-	cert = aws_conf[env].get('cert')
+	cert = aws_conf.get('cert')
 	if cert:
 		if not os.path.exists(cert):
 			cert = None
@@ -305,6 +538,7 @@ def _get_creds_from_aws_config_file(profile):
 				' readable'.format(os.environ['AWS_CONFIG_FILE']))
 		return None
 
+	import ConfigParser
 	config = ConfigParser.RawConfigParser()
 	config.read(os.environ['AWS_CONFIG_FILE'])
 
@@ -409,6 +643,22 @@ def _set_environment(creds):
 	elif "AWS_SESSION_TOKEN" in os.environ:
 		del os.environ['AWS_SESSION_TOKEN']
 
+def get_creds_for_environment(env):
+	"""Credentials from the environment's own configuration, or None:
+	its yaml config file, legacy ~/.aws/aws-<env>.conf, or its profile in
+	the aws config file.
+	"""
+	# Grab credentials from the yaml config files.
+	creds = _get_creds_from_environment_yaml(env)
+
+	# Grab credentials from legacy ~/.aws/aws-*.conf
+	creds = creds or _get_creds_from_legacy_aws_conf(env)
+
+	# Grab credentials from the aws config file.
+	creds = creds or _get_creds_from_aws_config_file(env)
+
+	return creds
+
 def get_keys(options):
 	"""
 	Returns the access and secret key based on (in order of precidence):
@@ -432,8 +682,14 @@ def get_keys(options):
 			env = os.environ['AWS_ACCOUNT']
 		else:
 			if options.forceiam:
-				#if there is no env and we are using force iam, we default
-				#to the instance profile autoconfigure.
+				#if there is no env and we are using force iam, we use the
+				#instance role's keys, kept fresh in the background, or
+				#failing that, boto's instance profile autoconfigure.
+				provider = get_credential_provider()
+				creds = provider and provider.get()
+				if creds:
+					_set_environment(creds)
+					return creds
 				return AwsCreds()
 
 	readmode = 'readonly'
@@ -449,14 +705,7 @@ def get_keys(options):
 	creds = creds or _get_creds_from_options(options)
 
 	if env:
-		# Grab credentials from the yaml config files.
-		creds = creds or _get_creds_from_environment_yaml(env)
-
-		# Grab credentials from legacy ~/.aws/aws-*.conf
-		creds = creds or _get_creds_from_legacy_aws_conf(env)
-
-		# Grab credentials from the aws config file.
-		creds = creds or _get_creds_from_aws_config_file(env)
+		creds = creds or get_creds_for_environment(env)
 
 	# Grab credentials from the aws credential file.
 	creds = creds or _get_creds_from_aws_credential_file()
@@ -471,6 +720,53 @@ def get_keys(options):
 
 	return creds
 
+# Parsed yaml files, by path: ((inode, mtime, size), contents)
+_yaml_files = {}
+
+def _load_yaml(filename):
+	"""Parse a yaml file, or return None if there isn't one.  Files are
+	only parsed again once they've changed (by inode, mtime or size).
+	"""
+	try:
+		stat = os.stat(filename)
+	except OSError:
+		_yaml_files.pop(filename, None)
+		return None
+	version = (stat.st_ino, stat.st_mtime, stat.st_size)
+	cached = _yaml_files.get(filename)
+	if cached is not None and cached[0] == version:
+		return cached[1]
+	import yaml
+	with open(filename) as yaml_file:
+		contents = yaml.load(yaml_file, Loader=_yaml_loader())
+	_yaml_files[filename] = (version, contents)
+	return contents
+
+def _get_aws_conf(env):
+	"""Read the aws config of a single environment from
+	~/.k.aws/<env>.yml or, failing that,
+	/etc/knewton/configuration/aws/<env>.yml.  Returns None if neither
+	exists.
+	"""
+	if not env or os.sep in env:
+		return None
+	# config files under ~/.k.aws should override those under
+	# /etc/knewton/configuration/aws
+	for directory in (K_AWS_PATH, AWS_PATH):
+		conf = _load_yaml(os.path.join(directory, env + ".yml"))
+		if conf is not None:
+			return conf
+	return None
+
+def get_environment_names():
+	"""The names of the environments that have a yaml config file, under
+	/etc/knewton/configuration/aws or ~/.k.aws, without reading them."""
+	names = set()
+	for directory in (AWS_PATH, K_AWS_PATH):
+		for config_file in glob.glob(os.path.join(directory, "*.yml")):
+			names.add(os.path.basename(config_file)[:-len(".yml")])
+	return sorted(names - set(NOT_ENVIRONMENTS))
+
 def _parse_aws_confs():
 	"""Read aws config from yaml files located in the AWS_PATH.  This
 	provides file-based credentials (e.g. IAMs generated by
@@ -478,30 +774,21 @@ def _parse_aws_confs():
 	"""
 	configs = {}
 
-	if os.path.exists(AWS_PATH):
-		for config_file in glob.glob(os.path.join(AWS_PATH, "*.yml")):
-			path, fn = os.path.split(config_file)
-			env, ext = fn.split('.')
-			with open(config_file) as yaml_file:
-				configs[env] = yaml.load(yaml_file)
-
-	# config files under ~/.k.aws should override those under
-	# /etc/knewton/configuration/aws
-	if os.path.exists(K_AWS_PATH):
-		for config_file in glob.glob(os.path.join(K_AWS_PATH, "*.yml")):
-			path, fn = os.path.split(config_file)
-			env, ext = fn.split('.')
-			with open(config_file) as yaml_file:
-				configs[env] = yaml.load(yaml_file)
+	for env in get_environment_names():
+		conf = _get_aws_conf(env)
+		if conf is not None:
+			configs[env] = conf
 
 	return configs
 
 def get_keys_for_environment(env):
 	"""Given an environment, get those keys from the appropriate
 	aws configuration source."""
-	aws_conf = _parse_aws_confs()
-	access = aws_conf[env]['access_key']
-	secret = aws_conf[env]['secret_key']
+	aws_conf = _get_aws_conf(env)
+	if aws_conf is None:
+		raise KeyError(env)
+	access = aws_conf['access_key']
+	secret = aws_conf['secret_key']
 	return access, secret
 
 def get_aws_options(parser, rw=False):
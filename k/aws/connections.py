@@ -0,0 +1,136 @@
+"""A process-wide registry of boto connections, shared by the connect()
+functions of the k.aws service modules.
+
+Each boto connection keeps its own pool of keep-alive HTTP(S) connections,
+so making a new one for every request, or every thread, means a new TLS
+handshake each time.  Instead, connect() checks a connection out of the
+registry, keyed by the service, the (region) credentials and anything
+else that changes how it's made, such as the s3 calling format:
+
+ * A thread gets the same connection every time it asks for the same key,
+   so nothing is shared by two threads at once.
+ * Connections held by threads that have finished are checked back in, as
+   are those of a thread that calls release(), and handed to the next
+   thread that needs one.  At most MAX_IDLE of them are kept per key, and
+   the rest are closed.
+ * After a fork the child starts with an empty registry, rather than
+   share sockets with its parent.
+
+Example:
+
+    @k.aws.connections.pooled("ec2")
+    def connect(creds):
+        ...
+"""
+
+import functools
+import os
+import threading
+
+#: Idle connections kept per key; more than that are closed.
+MAX_IDLE = 8
+
+_lock = threading.Lock()
+_pid = None
+# Connections checked out, by thread ident: {key: connection}
+_checked_out = {}
+# Connections not checked out, by key: [connection]
+_idle = {}
+
+def _close(conn):
+	try:
+		conn.close()
+	except Exception:
+		pass
+
+def _check_in(key, conn):
+	idle = _idle.setdefault(key, [])
+	if len(idle) < MAX_IDLE:
+		idle.append(conn)
+	else:
+		_close(conn)
+
+def _reclaim():
+	"""Check in the connections of threads that have finished"""
+	alive = set(thread.ident for thread in threading.enumerate())
+	for ident in list(_checked_out):
+		if ident not in alive:
+			for key, conn in _checked_out.pop(ident).items():
+				_check_in(key, conn)
+
+def _reset_after_fork():
+	global _pid
+	if _pid != os.getpid():
+		_pid = os.getpid()
+		_checked_out.clear()
+		_idle.clear()
+
+def get(key, factory):
+	"""
+	The calling thread's connection for key, checked out of the idle
+	connections or else made with factory().
+
+	:param key: hashable description of the connection
+	:param factory: makes a new connection
+	:type factory: callable
+	"""
+	ident = threading.current_thread().ident
+	with _lock:
+		_reset_after_fork()
+		conn = _checked_out.get(ident, {}).get(key)
+		if conn is not None:
+			return conn
+		_reclaim()
+		idle = _idle.get(key)
+		if idle:
+			conn = idle.pop()
+	if conn is None:
+		conn = factory()
+	with _lock:
+		_checked_out.setdefault(ident, {})[key] = conn
+	return conn
+
+def release():
+	"""Check in the calling thread's connections, for other threads"""
+	ident = threading.current_thread().ident
+	with _lock:
+		_reset_after_fork()
+		for key, conn in _checked_out.pop(ident, {}).items():
+			_check_in(key, conn)
+
+def clear():
+	"""Forget all connections, closing the idle ones"""
+	with _lock:
+		for idle in _idle.values():
+			for conn in idle:
+				_close(conn)
+		_idle.clear()
+		_checked_out.clear()
+
+def pooled(service, key=None):
+	"""
+	Decorate a connect(creds, ...) function to hand out connections from
+	the registry.  By default connections are keyed by all of the
+	arguments; key(*args, **kwargs), if given, returns the part of them
+	that makes connections differ.
+
+	:param service: name of the service, e.g. "ec2"
+	:type service: str
+	"""
+	def decorator(connect):
+		@functools.wraps(connect, [name for name in
+			functools.WRAPPER_ASSIGNMENTS if hasattr(connect, name)])
+		def pooled_connect(*args, **kwargs):
+			if key is not None:
+				parts = key(*args, **kwargs)
+			else:
+				parts = (args, tuple(sorted(kwargs.items())))
+			return get((service, parts),
+				lambda: connect(*args, **kwargs))
+		return pooled_connect
+	return decorator
+
+# Local Variables:
+# tab-width: 4
+# indent-tabs-mode: t
+# End:
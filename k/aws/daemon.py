@@ -0,0 +1,360 @@
+"""A long running k.aws daemon, which runs command line tools in its own
+process so that repeated invocations don't each pay for starting python,
+importing boto, reading credentials, TLS handshakes and listing the
+account's inventory.
+
+The daemon (bin/k.aws-daemon) listens on a Unix socket, by default
+~/.k.aws/daemon.sock or else $K_AWS_DAEMON_SOCKET.  A tool that can be
+run by it ends with
+
+    if __name__ == '__main__':
+        k.aws.daemon.run(main)
+
+which sends the script's path, its arguments, working directory and
+environment to the daemon, writes what the daemon streams back to stdout
+and stderr, and exits with the tool's exit code.  When no daemon is
+listening, or K_AWS_NO_DAEMON is set, main() is simply called in-process.
+
+The daemon runs one tool at a time, since tools share sys.argv,
+sys.stdout and os.environ, and keeps what they leave behind between
+runs: imported modules, parsed credential files, the connections in
+k.aws.connections and results cached with cached() for up to --cache-ttl
+seconds.  Outside the daemon cached() doesn't cache anything, so tools
+behave exactly as before when run on their own.
+
+Example:
+
+    conn = k.aws.ec2.connect(creds)
+    instances = k.aws.daemon.cached(("instances", creds),
+        lambda: k.aws.ec2.KInstances(conn))
+"""
+
+import errno
+import imp
+import json
+import logging
+import os
+import socket
+import struct
+import sys
+import time
+import traceback
+from StringIO import StringIO
+import k.aws.config
+
+DEFAULT_SOCKET = os.path.join(k.aws.config.K_AWS_PATH, "daemon.sock")
+DEFAULT_CACHE_TTL = 60
+CHUNK_SIZE = 64 * 1024
+
+# Each frame the daemon sends is a channel byte, a 4 byte length and that
+# many bytes of payload
+FRAME_HEADER = struct.Struct("!cI")
+STDOUT = b"o"
+STDERR = b"e"
+EXIT = b"x"
+# Sent instead of any output when the daemon can't run the tool, which is
+# then run in-process
+FALLBACK = b"f"
+
+# Caches, only used while serving
+_serving = False
+_cache_ttl = DEFAULT_CACHE_TTL
+_cache = {}
+_scripts = {}
+
+def socket_path():
+	return os.environ.get("K_AWS_DAEMON_SOCKET") or DEFAULT_SOCKET
+
+def cached(key, function):
+	"""
+	function(), or in the daemon, the value it returned under the same key
+	up to cache_ttl seconds ago.  Keys should include the credentials (and
+	region) the value was fetched with.
+	"""
+	if not _serving:
+		return function()
+	now = time.time()
+	hit = _cache.get(key)
+	if hit is not None and now - hit[0] < _cache_ttl:
+		return hit[1]
+	value = function()
+	_cache[key] = (now, value)
+	return value
+
+def _recv_exactly(sock, size):
+	data = []
+	while size > 0:
+		chunk = sock.recv(min(size, CHUNK_SIZE))
+		if not chunk:
+			raise EOFError("Connection closed")
+		data.append(chunk)
+		size -= len(chunk)
+	return b"".join(data)
+
+def _send_frame(sock, channel, payload):
+	sock.sendall(FRAME_HEADER.pack(channel, len(payload)) + payload)
+
+class _Stream(object):
+	"""A file-like object that sends what's written to it down a channel"""
+	def __init__(self, sock, channel):
+		self.sock = sock
+		self.channel = channel
+		self.buffer = []
+		self.size = 0
+
+	def write(self, data):
+		if isinstance(data, unicode):
+			data = data.encode("utf-8")
+		self.buffer.append(data)
+		self.size += len(data)
+		if self.size >= CHUNK_SIZE:
+			self.flush()
+
+	def writelines(self, lines):
+		for line in lines:
+			self.write(line)
+
+	def flush(self):
+		if self.buffer:
+			data = b"".join(self.buffer)
+			self.buffer = []
+			self.size = 0
+			_send_frame(self.sock, self.channel, data)
+
+	def isatty(self):
+		return False
+
+def request(path, script, argv, stdout, stderr, cwd=None, env=None):
+	"""
+	Have the daemon listening on path run a script, writing its output to
+	stdout and stderr.  Returns the exit code, or None if there's no daemon
+	or it can't run the script.
+	"""
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		try:
+			sock.connect(path)
+		except socket.error:
+			return None
+		message = {
+			"script": script,
+			"argv": list(argv),
+			"cwd": cwd or os.getcwd(),
+			"env": dict(os.environ if env is None else env),
+		}
+		sock.sendall(json.dumps(message).encode("utf-8") + b"\n")
+		started = False
+		while True:
+			try:
+				channel, size = FRAME_HEADER.unpack(
+					_recv_exactly(sock, FRAME_HEADER.size))
+				payload = _recv_exactly(sock, size)
+			except (EOFError, socket.error) as err:
+				if not started:
+					return None
+				stderr.write(b"k.aws daemon went away: " +
+					str(err).encode("utf-8") + b"\n")
+				return 1
+			if channel == FALLBACK and not started:
+				return None
+			started = True
+			if channel == STDOUT:
+				stdout.write(payload)
+			elif channel == STDERR:
+				stderr.write(payload)
+			elif channel == EXIT:
+				stdout.flush()
+				return int(payload)
+	finally:
+		sock.close()
+
+def run(main):
+	"""
+	Run a command line tool in the daemon if there is one, and exit with
+	its exit code; otherwise call main().
+	"""
+	if not os.environ.get("K_AWS_NO_DAEMON"):
+		code = request(socket_path(), os.path.realpath(sys.argv[0]),
+			sys.argv[1:], sys.stdout, sys.stderr)
+		if code is not None:
+			sys.stdout.flush()
+			sys.exit(code)
+	return main()
+
+def _load_script(path):
+	"""The script at path, loaded as a module, or None if it can't be"""
+	try:
+		mtime = os.stat(path).st_mtime
+	except OSError:
+		return None
+	loaded = _scripts.get(path)
+	if loaded is not None and loaded[0] == mtime:
+		return loaded[1]
+	name = "k_aws_daemon_" + "".join(
+		c if c.isalnum() else "_" for c in os.path.basename(path))
+	try:
+		module = imp.load_source(name, path)
+	except Exception:
+		logging.exception("k.aws daemon: can't load {0}".format(path))
+		return None
+	if not callable(getattr(module, "main", None)):
+		return None
+	_scripts[path] = (mtime, module)
+	return module
+
+def _exit_code(err, stderr):
+	if err.code is None:
+		return 0
+	if isinstance(err.code, int):
+		return err.code
+	stderr.write(str(err.code) + "\n")
+	return 1
+
+def _run_script(conn, message):
+	"""Run a script's main() with conn as its stdout and stderr"""
+	module = _load_script(message["script"])
+	if module is None:
+		_send_frame(conn, FALLBACK, b"")
+		return
+	cwd = os.getcwd()
+	try:
+		os.chdir(message["cwd"])
+	except OSError as err:
+		logging.warning("k.aws daemon: can't run in {0}: {1}".format(
+			message["cwd"], err))
+		_send_frame(conn, FALLBACK, b"")
+		return
+	saved = (sys.argv, sys.stdin, sys.stdout, sys.stderr, dict(os.environ),
+		cwd, logging.root.handlers[:], logging.root.level)
+	stdout, stderr = _Stream(conn, STDOUT), _Stream(conn, STDERR)
+	code = 1
+	try:
+		sys.argv = [message["script"]] + message["argv"]
+		sys.stdin = StringIO()
+		sys.stdout, sys.stderr = stdout, stderr
+		os.environ.clear()
+		os.environ.update(message["env"])
+		logging.root.handlers = []
+		try:
+			module.main()
+			code = 0
+		except SystemExit as err:
+			code = _exit_code(err, stderr)
+		except Exception:
+			stderr.write(traceback.format_exc())
+	finally:
+		(sys.argv, sys.stdin, sys.stdout, sys.stderr, environ, cwd,
+			logging.root.handlers, level) = saved
+		logging.root.setLevel(level)
+		os.environ.clear()
+		os.environ.update(environ)
+		os.chdir(cwd)
+	stdout.flush()
+	stderr.flush()
+	_send_frame(conn, EXIT, str(code).encode("ascii"))
+
+def _handle(conn):
+	reader = conn.makefile("rb")
+	try:
+		line = reader.readline()
+		if not line:
+			return
+		message = json.loads(line.decode("utf-8"))
+		start = time.time()
+		_run_script(conn, message)
+		logging.info("k.aws daemon: ran {0} in {1:.3f}s".format(
+			os.path.basename(message["script"]), time.time() - start))
+	except (socket.error, EOFError) as err:
+		logging.info("k.aws daemon: client went away: {0}".format(err))
+	except ValueError as err:
+		logging.warning("k.aws daemon: bad request: {0}".format(err))
+	except Exception:
+		logging.exception("k.aws daemon: failed to handle a request")
+	finally:
+		reader.close()
+		conn.close()
+
+def _listen(path):
+	"""A socket listening on path, replacing a stale socket file"""
+	directory = os.path.dirname(path)
+	if directory and not os.path.isdir(directory):
+		os.makedirs(directory, 0o700)
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		sock.bind(path)
+	except socket.error as err:
+		if err.errno != errno.EADDRINUSE:
+			raise
+		probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			probe.connect(path)
+		except socket.error:
+			os.unlink(path)
+			sock.bind(path)
+		else:
+			raise Exception("A k.aws daemon is already listening on %s" % path)
+		finally:
+			probe.close()
+	os.chmod(path, 0o600)
+	sock.listen(16)
+	return sock
+
+def serve(path=None, cache_ttl=DEFAULT_CACHE_TTL, idle_timeout=0):
+	"""
+	Run tools for clients on the Unix socket at path until there has been
+	no request for idle_timeout seconds (or forever if it's 0).
+
+	:param path: socket path, by default socket_path()
+	:type path: str
+	:param cache_ttl: seconds that values from cached() are kept
+	:type cache_ttl: float
+	"""
+	global _serving, _cache_ttl
+	path = path or socket_path()
+	sock = _listen(path)
+	_serving, _cache_ttl = True, cache_ttl
+	logging.info("k.aws daemon: listening on {0}".format(path))
+	try:
+		sock.settimeout(idle_timeout or None)
+		while True:
+			try:
+				conn, _ = sock.accept()
+			except socket.timeout:
+				logging.info("k.aws daemon: idle for {0}s, exiting".format(
+					idle_timeout))
+				return
+			conn.settimeout(None)
+			_handle(conn)
+	finally:
+		_serving = False
+		sock.close()
+		try:
+			os.unlink(path)
+		except OSError:
+			pass
+
+def get_daemon_options(parser):
+	"""
+	Add the daemon's options to the option parser.
+
+	:param parser: option parser
+	:type parser: optparse.OptionParser
+
+	:rtype: optparse.OptionParser
+	"""
+	parser.add_option(
+		"--socket", dest="socket", default=None,
+		help="Unix socket to listen on (Default: %s)" % DEFAULT_SOCKET)
+	parser.add_option(
+		"--cache-ttl", dest="cache_ttl", type=float, default=DEFAULT_CACHE_TTL,
+		help="Seconds to keep listings such as instances (Default: %d)" %
+			DEFAULT_CACHE_TTL)
+	parser.add_option(
+		"--idle-timeout", dest="idle_timeout", type=float, default=0,
+		help="Exit after this many seconds without a request (Default: never)")
+	return parser
+
+# Local Variables:
+# tab-width: 4
+# indent-tabs-mode: t
+# End:
@@ -1,12 +1,13 @@
 import copy
 import itertools
 import boto
-import boto.ec2
 import k.aws.util
 import warnings
-from k.aws.config import AwsCreds, connection_hash
+from k.aws.config import AwsCreds, connection_hash, register_connection
 from k.aws.config import RegionAwsCreds, region_connection_hash
+from k.aws.connections import pooled
 
+@pooled("ec2")
 def connect(creds):
 	"""
 	Connect to ec2, with user-provided options.
@@ -17,10 +18,12 @@ def connect(creds):
 	:rtype: boto.ec2.connection.EC2Connection
 	"""
 	if isinstance(creds, AwsCreds):
-		return boto.connect_ec2(**connection_hash(creds))
+		return register_connection(creds,
+			boto.connect_ec2(**connection_hash(creds)))
 	elif isinstance(creds, RegionAwsCreds):
-		return boto.ec2.connect_to_region(
-			**region_connection_hash(creds))
+		from boto.ec2 import connect_to_region
+		return register_connection(creds,
+			connect_to_region(**region_connection_hash(creds)))
 	raise Exception("Unrecognized credential type: %s" % creds)
 
 def parse_ec2_launch(lines, base):
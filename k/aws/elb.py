@@ -1,9 +1,10 @@
 import os
 import boto
-import boto.ec2.elb
-from k.aws.config import AwsCreds, connection_hash
+from k.aws.config import AwsCreds, connection_hash, register_connection
 from k.aws.config import RegionAwsCreds, region_connection_hash
+from k.aws.connections import pooled
 
+@pooled("elb")
 def connect(creds):
 	"""
 	Connect to autoscale, with user-provided options.
@@ -14,10 +15,12 @@ def connect(creds):
 	:rtype: boto.ec2.elb.ELBConnection
 	"""
 	if isinstance(creds, AwsCreds):
-		return boto.connect_elb(**connection_hash(creds))
+		return register_connection(creds,
+			boto.connect_elb(**connection_hash(creds)))
 	elif isinstance(creds, RegionAwsCreds):
-		return boto.ec2.elb.connect_to_region(
-			**region_connection_hash(creds))
+		from boto.ec2.elb import connect_to_region
+		return register_connection(creds,
+			connect_to_region(**region_connection_hash(creds)))
 	raise Exception("Unrecognized credential type: %s" % creds)
 
 
@@ -0,0 +1,262 @@
+"""Run read operations across regions and accounts concurrently, and merge
+the results.
+
+across_regions() calls a function with the k.aws.config.RegionAwsCreds of
+each region, a few regions at a time in threads, and yields a Result for
+each region, tagged with the region name, in the order the regions were
+given.  The function should connect with the connect() of a k.aws service
+module (so each thread keeps its own connection per region), and return
+a list rather than a generator, so that the requests happen in the
+threads.  merged() flattens the results into (region name, item) pairs.
+
+A region that fails doesn't stop the others: its Result carries the
+exception, and merged() raises a FanoutError once the other regions'
+items have all been yielded.
+
+across_environments() does the same across the configured environments
+(k.aws.config.get_environment_names()), optionally crossed with regions,
+tagging results with the environment, or (environment, region).  Each
+environment's credentials are resolved first, and at most per_account
+calls run against any one environment at once, to stay under its API
+throttles.  Tools add --all-envs and --all-regions with
+get_fanout_options(), and across_options() and write_merged() do the rest.
+
+Example:
+
+    def list_dbs(region_creds):
+        return list(k.aws.rds.connect(region_creds).get_all_dbinstances())
+
+    creds = k.aws.config.get_keys(options)
+    results = k.aws.fanout.across_regions(list_dbs, creds)
+    for region_name, db in k.aws.fanout.merged(results):
+        print region_name, db.id
+"""
+
+import logging
+import sys
+import threading
+from collections import namedtuple
+import k.aws.config
+from k.aws.config import DEFAULT_REGION_NAME, RegionAwsCreds
+
+DEFAULT_WORKERS = 8
+DEFAULT_PER_ACCOUNT = 2
+
+Result = namedtuple('Result', ['tag', 'value', 'error'])
+
+class FanoutError(Exception):
+	"""Some of the calls failed; errors is a list of (tag, exception)"""
+	def __init__(self, errors):
+		Exception.__init__(self, "; ".join(
+			"%s: %s" % (tag, err) for tag, err in errors))
+		self.errors = errors
+
+def _call(task):
+	function, tag, argument = task
+	try:
+		return Result(tag, function(argument), None)
+	except Exception as err:
+		logging.debug("fanout: {0} failed".format(tag), exc_info=True)
+		return Result(tag, None, err)
+
+def _fan_out(tasks, workers):
+	"""fan_out(), for a list of (function, tag, argument)"""
+	if not tasks:
+		return
+	from multiprocessing.pool import ThreadPool
+	pool = ThreadPool(processes=max(1, min(workers, len(tasks))))
+	try:
+		for result in pool.imap(_call, tasks):
+			yield result
+	finally:
+		pool.terminate()
+		pool.join()
+
+def fan_out(function, tasks, workers=DEFAULT_WORKERS):
+	"""
+	Call function(argument) for each (tag, argument) in tasks, up to
+	workers at a time, yielding a Result for each in the order of tasks.
+
+	:type tasks: list of (tag, argument) tuples
+	:type workers: int
+	"""
+	return _fan_out([(function, tag, argument) for tag, argument in tasks],
+		workers)
+
+def get_region_names(creds):
+	"""The names of all the regions, as ec2 lists them for the account"""
+	import k.aws.ec2
+	conn = k.aws.ec2.connect(creds)
+	return sorted(region.name for region in conn.get_all_regions())
+
+def across_regions(function, creds, region_names=None,
+		workers=DEFAULT_WORKERS):
+	"""
+	Call function(region_creds) for each region, tagging each Result with
+	the region name.
+
+	:param creds: credentials to use in every region
+	:type creds: k.aws.config.AwsCreds
+	:param region_names: regions, by default all of them
+	:type region_names: list of str or None
+	"""
+	if region_names is None:
+		region_names = get_region_names(creds)
+	return fan_out(function,
+		[(name, RegionAwsCreds(name, creds)) for name in region_names],
+		workers)
+
+def _throttled(function, semaphore):
+	def call(argument):
+		with semaphore:
+			return function(argument)
+	return call
+
+def _failed(err):
+	def call(argument):
+		raise err
+	return call
+
+def get_environment_creds(env_names=None):
+	"""
+	[(env, creds)] for each environment, by default all of them.  Only the
+	environment's own configuration is used, never the credential file or
+	environment variables, which would run as some other account; creds
+	is the exception raised if the environment's credentials couldn't be
+	had.
+	"""
+	if env_names is None:
+		env_names = k.aws.config.get_environment_names()
+	env_creds = []
+	for env in env_names:
+		try:
+			creds = k.aws.config.get_creds_for_environment(env)
+			if not creds:
+				raise Exception("Unable to determine credentials for %s" % env)
+		except Exception as err:
+			logging.debug("fanout: no credentials for {0}".format(env),
+				exc_info=True)
+			creds = err
+		env_creds.append((env, creds))
+	return env_creds
+
+def across_environments(function, env_names=None, region_names=None,
+		all_regions=False, workers=DEFAULT_WORKERS,
+		per_account=DEFAULT_PER_ACCOUNT):
+	"""
+	Call function(creds) for each environment, tagging each Result with
+	the environment name, or with region_names (or all_regions),
+	function(region_creds) for each environment and region, tagging each
+	Result with (environment, region).  Results come region by region,
+	so that calls to different accounts run side by side.
+
+	:param env_names: environments, by default all of them
+	:type env_names: list of str or None
+	:param per_account: most calls run at once for one environment
+	:type per_account: int
+	"""
+	env_creds = get_environment_creds(env_names)
+	if all_regions:
+		usable = [creds for _, creds in env_creds
+			if not isinstance(creds, Exception)]
+		region_names = get_region_names(usable[0]) if usable else []
+	functions = {}
+	for env, creds in env_creds:
+		if isinstance(creds, Exception):
+			functions[env] = _failed(creds)
+		else:
+			functions[env] = _throttled(function,
+				threading.BoundedSemaphore(per_account))
+	if region_names is None:
+		tasks = [(functions[env], env, creds) for env, creds in env_creds]
+	else:
+		tasks = [(functions[env], (env, region_name),
+			creds if isinstance(creds, Exception) else
+				RegionAwsCreds(region_name, creds))
+			for region_name in region_names for env, creds in env_creds]
+	return _fan_out(tasks, workers)
+
+def across_options(function, options):
+	"""
+	function(region_creds) across the environments and regions chosen with
+	get_fanout_options(): every environment for --all-envs, or else the
+	credentials of the options, and every region for --all-regions, or
+	else the -r/--region of the options.
+	"""
+	region_names = None
+	if not options.all_regions:
+		region_names = [getattr(options, "region", None) or DEFAULT_REGION_NAME]
+	if options.all_envs:
+		return across_environments(function, region_names=region_names,
+			all_regions=options.all_regions, workers=options.workers,
+			per_account=options.per_account)
+	return across_regions(function, k.aws.config.get_keys(options),
+		region_names, options.workers)
+
+def merged(results):
+	"""
+	Yield (tag, item) for every item in the values of results, then raise
+	a FanoutError if any of them failed.
+	"""
+	errors = []
+	for result in results:
+		if result.error is not None:
+			errors.append((result.tag, result.error))
+			continue
+		for item in result.value:
+			yield result.tag, item
+	if errors:
+		raise FanoutError(errors)
+
+def write_merged(results, format_item=str, stream=None):
+	"""
+	Write a line for each item of results: its tag (the environment and/or
+	region) and format_item(item), separated by tabs.  Failures are written to
+	stderr.  Returns False if there were any.
+	"""
+	stream = stream or sys.stdout
+	try:
+		for tag, item in merged(results):
+			if not isinstance(tag, tuple):
+				tag = (tag,)
+			stream.write("\t".join(list(tag) + [format_item(item)]) + "\n")
+	except FanoutError as err:
+		for tag, error in err.errors:
+			if isinstance(tag, tuple):
+				tag = " ".join(tag)
+			sys.stderr.write("%s: %s\n" % (tag, error))
+		return False
+	return True
+
+def get_fanout_options(parser):
+	"""
+	Add the fan-out options to the option parser.
+
+	:param parser: option parser
+	:type parser: optparse.OptionParser
+
+	:rtype: optparse.OptionParser
+	"""
+	parser.add_option(
+		"--all-regions", dest="all_regions", default=False,
+		action="store_true",
+		help="Run in every region, prefixing output with the region")
+	parser.add_option(
+		"--all-envs", dest="all_envs", default=False, action="store_true",
+		help=' '.join(["Run in every configured environment, prefixing",
+			"output with the environment and region"]))
+	parser.add_option(
+		"--workers", dest="workers", type=int, default=DEFAULT_WORKERS,
+		help="Regions/environments to work on at once (Default: %d)" %
+			DEFAULT_WORKERS)
+	parser.add_option(
+		"--per-account", dest="per_account", type=int,
+		default=DEFAULT_PER_ACCOUNT,
+		help="Most requests at once to one environment (Default: %d)" %
+			DEFAULT_PER_ACCOUNT)
+	return parser
+
+# Local Variables:
+# tab-width: 4
+# indent-tabs-mode: t
+# End:
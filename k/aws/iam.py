@@ -1,11 +1,12 @@
 import os
 import boto
-import boto.iam
 import k.aws.util
-from k.aws.config import AwsCreds, connection_hash
+from k.aws.config import AwsCreds, connection_hash, register_connection
 from k.aws.config import RegionAwsCreds, region_connection_hash
+from k.aws.connections import pooled
 
 
+@pooled("iam")
 def connect(creds):
 	"""
 	Connect to autoscale, with user-provided options.
@@ -17,10 +18,12 @@ def connect(creds):
 
 	Note IAM cannot authenticate a user using STS credentials."""
 	if isinstance(creds, AwsCreds):
-		return boto.connect_iam(**connection_hash(creds))
+		return register_connection(creds,
+			boto.connect_iam(**connection_hash(creds)))
 	elif isinstance(creds, RegionAwsCreds):
-		return boto.iam.connect_to_region(
-			**region_connection_hash(creds))
+		from boto.iam import connect_to_region
+		return register_connection(creds,
+			connect_to_region(**region_connection_hash(creds)))
 	raise Exception("Unrecognized credential type: %s" % creds)
 
 
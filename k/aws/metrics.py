@@ -0,0 +1,246 @@
+"""Metrics for long running daemons, sent to statsd and to a stats file.
+
+A Metrics collects counters, gauges and timings in memory, and every
+interval seconds sends them as statsd lines over UDP (which graphite,
+via statsd, or any local listener can pick up) and writes a snapshot of
+them to a json stats file.  Counters are also reported as per second
+rates over the interval, and timings as percentiles.  Spool directories
+registered with watch_backlog() are looked at once per interval, so the
+backlog gauges cost one listing of each, however busy the daemon is.
+
+Sending metrics never raises: a statsd that isn't there, or a stats file
+that can't be written, is logged and otherwise ignored.
+
+Example:
+
+    metrics = k.aws.metrics.get_metrics(options, "gzip-respooler")
+    metrics.watch_backlog("backlog", "/var/spool/logs")
+    for files in k.aws.spool.watch("/var/spool/logs"):
+        start = time.time()
+        ...
+        metrics.incr("compress.files", len(files))
+        metrics.timing("compress.batch", time.time() - start)
+        metrics.maybe_flush()
+"""
+
+import json
+import logging
+import math
+import os
+import random
+import socket
+import threading
+import time
+from collections import defaultdict
+import k.aws.spool
+
+DEFAULT_INTERVAL = 10
+DEFAULT_STATSD_PORT = 8125
+#: Percentiles of each timing that are reported.
+PERCENTILES = (50, 90, 99)
+#: Most timings kept per name per interval; past that they are sampled.
+MAX_SAMPLES = 1000
+#: Largest statsd packet sent, to stay under common MTUs.
+MAX_PACKET = 512
+
+def parse_address(address):
+	"""(host, port) of a "host:port" or "host" statsd address"""
+	host, _, port = address.rpartition(':')
+	if not host:
+		return port, DEFAULT_STATSD_PORT
+	return host, int(port)
+
+def percentile(samples, percent):
+	"""Nearest rank percentile of sorted samples"""
+	if not samples:
+		return 0
+	rank = int(math.ceil(percent / 100.0 * len(samples)))
+	return samples[max(0, min(rank, len(samples)) - 1)]
+
+class Metrics(object):
+	"""
+	Counters, gauges and timings, flushed to statsd and a stats file
+	every interval seconds.  Safe to use from several threads.
+	"""
+	def __init__(self, prefix, statsd=None, stats_file=None,
+			interval=DEFAULT_INTERVAL):
+		self.prefix = prefix
+		self.stats_file = stats_file
+		self.interval = interval
+		self.address = None
+		self.sock = None
+		if statsd:
+			self.address = parse_address(statsd)
+			self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.lock = threading.Lock()
+		self.backlogs = {}
+		self.totals = defaultdict(int)
+		self.last_flush = time.time()
+		self._reset()
+
+	def _reset(self):
+		self.counters = defaultdict(int)
+		self.gauges = {}
+		self.timings = defaultdict(list)
+		self.seen = defaultdict(int)
+
+	@property
+	def enabled(self):
+		return self.sock is not None or self.stats_file is not None
+
+	def incr(self, name, value=1):
+		with self.lock:
+			self.counters[name] += value
+			self.totals[name] += value
+
+	def gauge(self, name, value):
+		with self.lock:
+			self.gauges[name] = value
+
+	def timing(self, name, seconds):
+		"""Record a duration (in seconds; it is reported in ms)"""
+		with self.lock:
+			self.seen[name] += 1
+			samples = self.timings[name]
+			if len(samples) < MAX_SAMPLES:
+				samples.append(seconds * 1000.0)
+			else:
+				index = random.randrange(self.seen[name])
+				if index < MAX_SAMPLES:
+					samples[index] = seconds * 1000.0
+
+	def watch_backlog(self, name, directory):
+		"""
+		Report the backlog of a spool directory, as the gauges
+		<name>.files, <name>.bytes and <name>.oldest_age (in seconds)
+		"""
+		self.backlogs[name] = directory
+
+	def maybe_flush(self):
+		"""Flush if it has been interval seconds since the last flush"""
+		if time.time() - self.last_flush >= self.interval:
+			self.flush()
+
+	def flush(self):
+		"""Send and write out the metrics collected since the last flush"""
+		now = time.time()
+		if not self.enabled:
+			# Nowhere to send them, so don't scan the backlogs either
+			with self.lock:
+				self._reset()
+				self.last_flush = now
+			return
+		for name, directory in self.backlogs.items():
+			try:
+				files, size, age = k.aws.spool.backlog(directory, now)
+			except OSError as err:
+				logging.warning("Metrics: can't read backlog of {0}: {1}".format(
+					directory, err))
+				continue
+			self.gauge(name + ".files", files)
+			self.gauge(name + ".bytes", size)
+			self.gauge(name + ".oldest_age", age)
+		with self.lock:
+			counters, gauges, timings = self.counters, self.gauges, self.timings
+			totals = dict(self.totals)
+			self._reset()
+			elapsed = max(now - self.last_flush, 1e-6)
+			self.last_flush = now
+		stats = {
+			"time": now,
+			"interval": elapsed,
+			"counters": {},
+			"gauges": dict(gauges),
+			"timings": {},
+		}
+		lines = []
+		for name in sorted(set(counters) | set(totals)):
+			value = counters.get(name, 0)
+			stats["counters"][name] = {"count": value, "total": totals[name],
+				"per_second": value / elapsed}
+			lines.append("{0}.{1}:{2}|c".format(self.prefix, name, value))
+		for name, value in sorted(gauges.items()):
+			lines.append("{0}.{1}:{2}|g".format(self.prefix, name, value))
+		for name, samples in sorted(timings.items()):
+			samples.sort()
+			summary = {"count": len(samples), "max": samples[-1]}
+			for percent in PERCENTILES:
+				summary["p%d" % percent] = percentile(samples, percent)
+			stats["timings"][name] = summary
+			lines.extend("{0}.{1}:{2:.3f}|ms".format(self.prefix, name, sample)
+				for sample in samples)
+		self._send(lines)
+		self._write(stats)
+
+	def _send(self, lines):
+		if self.sock is None:
+			return
+		packet = []
+		size = 0
+		for line in lines + [None]:
+			if packet and (line is None or size + len(line) + 1 > MAX_PACKET):
+				try:
+					self.sock.sendto("\n".join(packet).encode("utf-8"),
+						self.address)
+				except (socket.error, socket.gaierror) as err:
+					logging.debug("Metrics: can't send to statsd: {0}".format(err))
+				packet = []
+				size = 0
+			if line is not None:
+				packet.append(line)
+				size += len(line) + 1
+
+	def _write(self, stats):
+		if self.stats_file is None:
+			return
+		tmp_path = self.stats_file + ".tmp"
+		try:
+			with open(tmp_path, "w") as writer:
+				json.dump(stats, writer, indent=2, sort_keys=True)
+			os.rename(tmp_path, self.stats_file)
+		except (IOError, OSError) as err:
+			logging.warning("Metrics: can't write {0}: {1}".format(
+				self.stats_file, err))
+
+	def close(self):
+		self.flush()
+		if self.sock is not None:
+			self.sock.close()
+			self.sock = None
+
+def get_metrics(options, prefix):
+	"""
+	The Metrics configured by get_metrics_options(), under
+	options.metrics_prefix or else prefix
+	"""
+	return Metrics(options.metrics_prefix or prefix, options.statsd,
+		options.stats_file, options.metrics_interval)
+
+def get_metrics_options(parser):
+	"""
+	Add the metrics options to the option parser.
+
+	:param parser: option parser
+	:type parser: optparse.OptionParser
+
+	:rtype: optparse.OptionParser
+	"""
+	parser.add_option(
+		"--statsd", dest="statsd", default=None,
+		help="Send metrics to statsd at host[:port] over UDP")
+	parser.add_option(
+		"--stats-file", dest="stats_file", default=None,
+		help="Write the latest metrics to this json file")
+	parser.add_option(
+		"--metrics-prefix", dest="metrics_prefix", default=None,
+		help="Prefix of the metric names (Default: the program name)")
+	parser.add_option(
+		"--metrics-interval", dest="metrics_interval",
+		help="Seconds between sending metrics (Default: %d)" % DEFAULT_INTERVAL,
+		type=float, default=DEFAULT_INTERVAL)
+	return parser
+
+# Local Variables:
+# tab-width: 4
+# indent-tabs-mode: t
+# End:
@@ -1,9 +1,11 @@
-import boto.rds
+import boto
 import logging
 from datetime import datetime
-from k.aws.config import AwsCreds, connection_hash
+from k.aws.config import AwsCreds, connection_hash, register_connection
 from k.aws.config import RegionAwsCreds, region_connection_hash
+from k.aws.connections import pooled
 
+@pooled("rds")
 def connect(creds):
 	"""
 	Connect to RDS, with user-provided options.
@@ -14,9 +16,12 @@ def connect(creds):
 	:rtype: boto.rds.RDSConnection
 	"""
 	if isinstance(creds, AwsCreds):
-		return boto.connect_rds(**connection_hash(creds))
+		return register_connection(creds,
+			boto.connect_rds(**connection_hash(creds)))
 	elif isinstance(creds, RegionAwsCreds):
-		return boto.rds.connect_to_region(**region_connection_hash(creds))
+		from boto.rds import connect_to_region
+		return register_connection(creds,
+			connect_to_region(**region_connection_hash(creds)))
 	raise Exception("Unrecognized credential type: %s" % creds)
 
 def prune_snapshots(conn, instance_id, keep, prefix=None, dryrun=False):
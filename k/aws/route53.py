@@ -1,10 +1,11 @@
 import os
 import sys
 import boto
-import boto.route53
-from k.aws.config import AwsCreds, connection_hash
+from k.aws.config import AwsCreds, connection_hash, register_connection
 from k.aws.config import RegionAwsCreds, region_connection_hash
+from k.aws.connections import pooled
 
+@pooled("route53")
 def connect(creds):
 	"""
 	Connect to autoscale, with user-provided options.
@@ -15,8 +16,10 @@ def connect(creds):
 	:rtype: boto.route53.connection.Route53Connection
 	"""
 	if isinstance(creds, AwsCreds):
-		return boto.connect_route53(**connection_hash(creds))
+		return register_connection(creds,
+			boto.connect_route53(**connection_hash(creds)))
 	elif isinstance(creds, RegionAwsCreds):
-		return boto.route53.connect_to_region(
-			**region_connection_hash(creds))
+		from boto.route53 import connect_to_region
+		return register_connection(creds,
+			connect_to_region(**region_connection_hash(creds)))
 	raise Exception("Unrecognized credential type: %s" % creds)
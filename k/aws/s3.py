@@ -6,25 +6,32 @@ import collections
 import threading
 import datetime
 import sys
-import multiprocessing
 import traceback
 import hashlib
+import httplib
+import socket
 import time
 import boto
 import k.aws.config
+import k.aws.s3listing
 from cStringIO import StringIO
 from math import ceil, floor
 from threading import Thread
-from multiprocessing.pool import ThreadPool
-from multiprocessing import Pool
-from multiprocessing.synchronize import BoundedSemaphore
-from boto.s3.connection import OrdinaryCallingFormat
-from boto.s3.resumable_download_handler import ResumableDownloadHandler
-from k.aws.config import AwsCreds, connection_hash
+from Queue import Queue, Empty, Full
+from k.aws.config import AwsCreds, connection_hash, register_connection
 from k.aws.config import RegionAwsCreds, region_connection_hash
+from k.aws.connections import pooled
 
 ManualS3Options = collections.namedtuple('ManualS3Options', ["bucket"])
 
+ALL_USERS = 'http://acs.amazonaws.com/groups/global/AllUsers'
+AUTHENTICATED_USERS = 'http://acs.amazonaws.com/groups/global/AuthenticatedUsers'
+ACL_RETRY_COUNT = 5
+# Seconds between progress reports from parallel_set_acl
+PROGRESS_INTERVAL = 10
+# Most keys that s3 deletes in one request
+DELETE_BATCH_SIZE = 1000
+
 class FileNameException(Exception):
 	pass
 
@@ -37,10 +44,17 @@ def is_valid_dns_name(bucket_name):
 			return True
 	return False
 
+def _connection_key(creds, bucket_name=None, ordinary=False):
+	"""s3 connections differ by credentials and calling format"""
+	return (creds, bool(ordinary or
+		(bucket_name and not is_valid_dns_name(bucket_name))))
+
+@pooled("s3", key=_connection_key)
 def connect(creds, bucket_name=None, ordinary=False):
 	"""
 	Connect to s3 using a k.aws.config.AwsCreds named tuple
 	"""
+	from boto.s3.connection import OrdinaryCallingFormat
 	kwargs = {}
 	if ordinary:
 		kwargs['calling_format'] = OrdinaryCallingFormat()
@@ -53,7 +67,7 @@ def connect(creds, bucket_name=None, ordinary=False):
 		del kwargs['region_name']
 
 	conn = boto.connect_s3(**kwargs)
-	return conn
+	return register_connection(creds, conn)
 
 def get_bucket_name(options):
 	bucket_name = None
@@ -116,6 +130,7 @@ def split_and_put_multipart_key(bucket, key, filename, creds, mpsize,
 	# Creating and running worker pool on various file pieces. We wait for the
 	# workers to finish, then check for success.
 	pindices = range(1, piececount+1)			# noninclusive range endpoints
+	from multiprocessing import Pool
 	workers = Pool(processes=mpcount)
 	results = workers.map_async(put_multipart_piece, _pool_info(pindices))
 	_ = results.get()
@@ -222,6 +237,30 @@ def delete_key(bucket, prefix):
 	for key in keys:
 		bucket.delete_key(key)
 
+def delete_keys(bucket, names, batch_size=DELETE_BATCH_SIZE):
+	"""
+	Delete exactly the keys named, batch_size of them a request (whereas
+	delete_key() deletes every key that starts with a name).  Returns the
+	names of the keys that couldn't be deleted.
+	"""
+	failed = []
+	batch = []
+	for name in names:
+		batch.append(name)
+		if len(batch) == batch_size:
+			failed.extend(_delete_batch(bucket, batch))
+			batch = []
+	if batch:
+		failed.extend(_delete_batch(bucket, batch))
+	return failed
+
+def _delete_batch(bucket, names):
+	result = bucket.delete_keys(names, quiet=True)
+	for error in result.errors:
+		sys.stderr.write("Failed to delete {0}: {1}\n".format(
+			error.key, error.message))
+	return [error.key for error in result.errors]
+
 def key_exists(bucket, name):
 	if bucket.get_key(name):
 		return True
@@ -302,7 +341,7 @@ def get_s3_bucket_options(parser):
 		help="S3 Bucket Name (uses S3_BUCKET environment variable if not set)")
 	return parser
 
-def sync_local(bucket, localdir, prefix='', debug=False):
+def sync_local(bucket, localdir, prefix='', debug=False, keys=None):
 	""" Syncs a local directory with an S3 bucket. If prefix is specified, only
 	keys with the prefix will be synced locally.
 
@@ -310,8 +349,12 @@ def sync_local(bucket, localdir, prefix='', debug=False):
 	str localdir:                 target directory to be synced
 	str prefix:                   prefix to use when syncing keys
 	bool debug:                   debug output
+	iterable keys:                keys to sync, e.g. from
+	                              k.aws.s3listing.parallel_list() (defaults
+	                              to listing the bucket)
 	"""
-	keys = bucket.list(prefix=prefix)
+	if keys is None:
+		keys = bucket.list(prefix=prefix)
 	for key in keys:
 		try:
 			## If key is a directory, check whether that directory exists
@@ -335,6 +378,7 @@ def write_key_to_filename(key, outname, debug=False):
 	Note: downloads will be retried via a
 	boto.s3.resumable_download_handler.ResumableDownloadHandler
 	"""
+	from boto.s3.resumable_download_handler import ResumableDownloadHandler
 	if debug:
 		sys.stderr.write("Saving %s...\n\t" % outname)
 	key.get_contents_to_filename(outname,
@@ -539,6 +583,7 @@ def copy_key(src_key, dst_bucket, dst_key_name, part_size=500000000, retry_per_p
 		for r in ranges:
 			_copy_key_part_with_retry(r)
 	else:
+		from multiprocessing.pool import ThreadPool
 		p = ThreadPool(processes=parallel)
 		p.map(_copy_key_part_with_retry, ranges, 1)
 	end_time = time.time()
@@ -552,16 +597,12 @@ def copy_key(src_key, dst_bucket, dst_key_name, part_size=500000000, retry_per_p
 
 def parallel_copy_bucket(creds, src_bucket_name, dst_bucket_name,
 		src_ordinary=False, dst_ordinary=False,
-		prefix=None, threads=10, timeout=300, verbose=False):
+		prefix=None, threads=10, timeout=300, verbose=False, list_threads=1):
 	status = True
-	src_conn = k.aws.s3.connect(
-		creds, bucket_name=src_bucket_name, ordinary=src_ordinary)
-	src_bucket = src_conn.get_bucket(src_bucket_name)
-	if prefix:
-		rs = src_bucket.list(prefix)
-	else:
-		rs = src_bucket.list()
+	rs = k.aws.s3listing.list_keys(creds, src_bucket_name, prefix,
+		src_ordinary, threads=list_threads, ordered=False)
 	key_copy_thread_list = []
+	from multiprocessing.synchronize import BoundedSemaphore
 	pool_sema = BoundedSemaphore(value=threads)
 	total_keys = 0
 
@@ -688,6 +729,7 @@ def parallel_delete_bucket(creds, bucket_name, ordinary=False, prefix=None,
 	else:
 		rs = bucket.list()
 	thread_list = []
+	from multiprocessing.synchronize import BoundedSemaphore
 	pool_sema = BoundedSemaphore(value=threads)
 	total_keys = 0
 
@@ -758,3 +800,171 @@ class DeleteKey(Thread):
 			traceback.print_tb(tback)
 		finally:
 			self.pool_sema.release()
+
+def canned_acl_grants(acl, owner_id, bucket_owner_id=None):
+	"""
+	The set of (grantee, permission) tuples that setting a canned acl on
+	a key owned by owner_id results in, or None if that can't be worked
+	out.  Grantees are canonical user ids or group uris.
+	"""
+	grants = set([(owner_id, 'FULL_CONTROL')])
+	if acl == 'private':
+		return grants
+	if acl == 'public-read':
+		return grants | set([(ALL_USERS, 'READ')])
+	if acl == 'public-read-write':
+		return grants | set([(ALL_USERS, 'READ'), (ALL_USERS, 'WRITE')])
+	if acl == 'authenticated-read':
+		return grants | set([(AUTHENTICATED_USERS, 'READ')])
+	if bucket_owner_id is None:
+		return None
+	if acl == 'bucket-owner-read':
+		return grants | set([(bucket_owner_id, 'READ')])
+	if acl == 'bucket-owner-full-control':
+		return grants | set([(bucket_owner_id, 'FULL_CONTROL')])
+	return None
+
+def acl_matches(policy, acl, bucket_owner_id=None):
+	"""Whether a key's boto.s3.acl.Policy is what the canned acl would set"""
+	expected = canned_acl_grants(acl, policy.owner.id, bucket_owner_id)
+	if expected is None:
+		return False
+	current = set((grant.id or grant.uri, grant.permission)
+		for grant in policy.acl.grants)
+	return current == expected
+
+def _with_retry(function, retry_count=ACL_RETRY_COUNT):
+	"""
+	Call function, retrying connection errors and server side (5xx)
+	errors with a linear backoff.
+	"""
+	for attempt in range(retry_count):
+		try:
+			return function()
+		except boto.exception.BotoServerError as bse:
+			if bse.status < 500 or attempt == retry_count - 1:
+				raise
+		except (socket.error, httplib.HTTPException):
+			if attempt == retry_count - 1:
+				raise
+		time.sleep(attempt + 1)
+
+def parallel_set_acl(creds, bucket_name, keys, acl, ordinary=False,
+		threads=10, skip_matching=False, verbose=False, progress=True):
+	"""
+	Set a canned acl on many keys with a pool of threads, each with its
+	own connection.  Returns a dict with the number of keys that were
+	"set", "skipped" (because skip_matching was set and they already had
+	the acl) or "failed".
+
+	creds: a set of creds that can be used by k.aws.s3.connect
+	bucket_name: string, name of the bucket the keys are in
+	keys: iterable of key names, or of boto.s3.key.Key
+	acl: string, one of boto.s3.acl.CannedACLStrings
+	threads: int, number of concurrent connections
+	skip_matching: boolean, read each key's acl first and leave it alone if it matches
+	verbose: boolean, print each key as its acl is set
+	progress: boolean, report progress to stderr every PROGRESS_INTERVAL seconds
+	"""
+	tasks = Queue(threads * 16)
+	results = Queue()
+	workers = [SetAcl(creds, bucket_name, acl, tasks, results,
+		ordinary=ordinary, skip_matching=skip_matching)
+		for _ in range(threads)]
+	for worker in workers:
+		worker.start()
+
+	counts = collections.defaultdict(int)
+	started = time.time()
+	reported = [started]
+	def record(result):
+		name, status, error = result
+		counts[status] += 1
+		if error is not None:
+			sys.stderr.write("ERROR: s3://{0}/{1}: {2}\n".format(
+				bucket_name, name, error))
+		elif verbose and status == 'set':
+			sys.stdout.write("Set ACL {0} on s3://{1}/{2}\n".format(
+				acl, bucket_name, name))
+		now = time.time()
+		if progress and now - reported[0] >= PROGRESS_INTERVAL:
+			reported[0] = now
+			done = counts['set'] + counts['skipped'] + counts['failed']
+			sys.stderr.write("{0} : {1} set, {2} skipped, {3} failed, {4:0.1f} keys/s\n".format(
+				datetime.datetime.now(), counts['set'], counts['skipped'],
+				counts['failed'], done / (now - started)))
+	def drain():
+		while True:
+			try:
+				record(results.get_nowait())
+			except Empty:
+				return
+
+	queued = 0
+	for key in keys:
+		name = getattr(key, 'name', key)
+		while True:
+			try:
+				tasks.put(name, timeout=0.5)
+				break
+			except Full:
+				drain()
+		queued += 1
+		drain()
+	for _ in workers:
+		tasks.put(None)
+	while sum(counts.values()) < queued:
+		record(results.get())
+	for worker in workers:
+		worker.join()
+	return counts
+
+class SetAcl(Thread):
+	"""
+	Sets a canned acl on each key name taken from tasks, until it takes
+	None, and puts a (name, status, error) tuple on results for each.
+	"""
+	def __init__(self, creds, bucket_name, acl, tasks, results,
+			ordinary=False, skip_matching=False):
+		Thread.__init__(self)
+		self.daemon = True
+		self.creds = creds
+		self.bucket_name = bucket_name
+		self.acl = acl
+		self.tasks = tasks
+		self.results = results
+		self.ordinary = ordinary
+		self.skip_matching = skip_matching
+		self.bucket = None
+		self.bucket_owner_id = None
+
+	def connect(self):
+		conn = k.aws.s3.connect(self.creds,
+			bucket_name=self.bucket_name, ordinary=self.ordinary)
+		self.bucket = conn.get_bucket(self.bucket_name, validate=False)
+		if self.skip_matching and self.acl.startswith('bucket-owner-'):
+			try:
+				self.bucket_owner_id = _with_retry(self.bucket.get_acl).owner.id
+			except boto.exception.S3ResponseError:
+				# Without the bucket owner, keys just never match
+				pass
+
+	def set_acl(self, name):
+		if self.bucket is None:
+			self.connect()
+		if self.skip_matching:
+			policy = _with_retry(lambda: self.bucket.get_acl(name))
+			if acl_matches(policy, self.acl, self.bucket_owner_id):
+				return 'skipped'
+		_with_retry(lambda: self.bucket.set_canned_acl(self.acl, name))
+		return 'set'
+
+	def run(self):
+		while True:
+			name = self.tasks.get()
+			if name is None:
+				return
+			try:
+				self.results.put((name, self.set_acl(name), None))
+			except Exception as e:
+				self.results.put((name, 'failed', e))
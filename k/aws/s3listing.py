@@ -0,0 +1,463 @@
+"""Prefix-sharded, concurrent listing of s3 buckets.
+
+bucket.list() walks a bucket one page (1000 keys) at a time, and each
+page needs the marker of the page before it, so listing a bucket with
+tens of millions of keys is hours of strictly serial round trips.
+
+This module splits the keyspace under a prefix into disjoint ranges
+("shards") and lists the shards concurrently, each on its own
+connection.  A shard is a (marker, end) tuple that covers every key
+name k under the prefix with marker < k <= end.  A marker of None is
+the start of the prefix, and an end of None is the end of the prefix.
+Because the shards are sorted and disjoint, reading them back in shard
+order yields the keys in the same global order that bucket.list() does.
+
+The shard boundaries are found by asking s3 for the common prefixes
+under the listing prefix (a delimiter query), descending a level or two
+if there are too few of them.  A flat keyspace has no common prefixes,
+in which case the boundaries are the listing prefix followed by each of
+a set of commonly used characters, which are start-after ranges.
+
+Example:
+
+    keys = k.aws.s3listing.parallel_list(creds, "some-bucket", "logs/",
+        threads=16)
+    for key in keys:
+        print key.name, key.size
+"""
+
+import httplib
+import logging
+import socket
+import string
+import sys
+import threading
+import time
+from collections import namedtuple
+from Queue import Queue, Empty, Full
+from boto import exception
+from boto.s3.prefix import Prefix
+import k.aws.s3
+
+DEFAULT_THREADS = 8
+#: Shards planned per listing thread, so that a slow shard doesn't hold
+#: up the whole listing.
+SHARDS_PER_THREAD = 4
+#: Pages buffered per shard before its thread waits on the reader.
+QUEUE_PAGES = 4
+#: Maximum number of delimiter pages read at any one prefix while
+#: planning shards.
+DISCOVERY_PAGES = 2
+#: How many levels of common prefixes to descend while planning shards.
+DISCOVERY_DEPTH = 2
+PAGE_SIZE = 1000
+RETRY_COUNT = 5
+#: Split points used for prefixes that have no common prefixes under
+#: them.  These must be sorted.
+FLAT_SPLIT_CHARS = sorted(string.digits + string.ascii_letters + "-._")
+
+_DONE = object()
+
+ListingDifference = namedtuple('ListingDifference', ['kind', 'name', 'src', 'dst'])
+
+class _Failure(object):
+	"""Carries an exception raised in a listing thread to the reader"""
+	def __init__(self, exc_info):
+		self.exc_info = exc_info
+
+def get_page(bucket, prefix='', marker='', delimiter='', max_keys=PAGE_SIZE,
+		retry_count=RETRY_COUNT):
+	"""
+	Fetch a single page of a listing, retrying on connection errors and
+	server side (5xx) errors with a linear backoff.
+
+	:type bucket: boto.s3.bucket.Bucket
+	:param bucket: The bucket to list
+
+	:rtype: boto.resultset.ResultSet
+	"""
+	for attempt in range(retry_count):
+		try:
+			return bucket.get_all_keys(prefix=prefix, marker=marker,
+				delimiter=delimiter, max_keys=max_keys)
+		except exception.BotoServerError as bse:
+			if bse.status < 500 or attempt == retry_count - 1:
+				raise
+			logging.info("get_page: retrying {0} after {1}".format(
+				marker, bse.status))
+		except (socket.error, httplib.HTTPException) as err:
+			if attempt == retry_count - 1:
+				raise
+			logging.info("get_page: retrying {0} after {1}".format(
+				marker, err))
+		time.sleep(attempt + 1)
+
+def common_prefixes(bucket, prefix='', delimiter='/', pages=DISCOVERY_PAGES):
+	"""
+	Return the sorted common prefixes directly under prefix, reading at
+	most the given number of delimiter pages.  The second value returned
+	is True when the listing at this level was cut short.
+	"""
+	found = []
+	marker = ''
+	for _ in range(pages):
+		rs = get_page(bucket, prefix, marker, delimiter)
+		names = [item.name for item in rs]
+		found.extend(item.name for item in rs if isinstance(item, Prefix))
+		if not rs.is_truncated or not names:
+			return sorted(found), False
+		marker = getattr(rs, 'next_marker', None) or max(names)
+	return sorted(found), True
+
+def discover_boundaries(bucket, prefix='', want=DEFAULT_THREADS,
+		delimiter='/', depth=DISCOVERY_DEPTH):
+	"""
+	Find at least want (where possible) sorted key names that split the
+	keyspace under prefix into ranges of comparable size, by walking the
+	common prefixes under it.  Falls back to single character split
+	points when the prefix has no common prefixes.
+	"""
+	prefix = prefix or ''
+	boundaries = []
+	level = [prefix]
+	for _ in range(depth):
+		found = []
+		for parent in level:
+			children, _ = common_prefixes(bucket, parent, delimiter)
+			found.extend(children)
+		if not found:
+			break
+		boundaries = sorted(set(boundaries + found))
+		if len(boundaries) >= want:
+			break
+		level = found
+	if not boundaries:
+		boundaries = [prefix + char for char in FLAT_SPLIT_CHARS]
+	return boundaries
+
+def shards_from_boundaries(boundaries, count):
+	"""
+	Turn a sorted list of split points into (at most) count disjoint
+	(marker, end) shards that together cover the whole keyspace.
+	"""
+	if count < 2 or not boundaries:
+		return [(None, None)]
+	if len(boundaries) >= count:
+		step = len(boundaries) / float(count)
+		boundaries = [boundaries[int(i * step)] for i in range(1, count)]
+	points = [None] + sorted(set(boundaries)) + [None]
+	return zip(points[:-1], points[1:])
+
+def plan_shards(bucket, prefix='', count=DEFAULT_THREADS * SHARDS_PER_THREAD,
+		delimiter='/'):
+	"""
+	Plan count disjoint shards covering all of the keys under prefix.
+
+	:rtype: list of (marker, end) tuples
+	"""
+	boundaries = discover_boundaries(bucket, prefix, count, delimiter)
+	return shards_from_boundaries(boundaries, count)
+
+def shard_pages(bucket, prefix, shard):
+	"""
+	Generator that yields the keys of one shard as lists, a page at a
+	time.
+	"""
+	marker, end = shard
+	marker = marker or ''
+	while True:
+		rs = get_page(bucket, prefix or '', marker)
+		page = []
+		for key in rs:
+			if end is not None and key.name > end:
+				if page:
+					yield page
+				return
+			page.append(key)
+		if page:
+			yield page
+			marker = page[-1].name
+		if not rs.is_truncated or not page:
+			return
+
+class ShardLister(threading.Thread):
+	"""
+	Lists shards taken, in order, from a queue of (index, shard) tuples
+	and puts (index, page) tuples on the reader's queue for that shard.
+	Each lister uses its own connection.
+	"""
+	def __init__(self, bucket_factory, prefix, tasks, queues, stop):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.bucket_factory = bucket_factory
+		self.prefix = prefix
+		self.tasks = tasks
+		self.queues = queues
+		self.stop = stop
+
+	def put(self, queue, item):
+		while not self.stop.is_set():
+			try:
+				queue.put(item, timeout=0.5)
+				return True
+			except Full:
+				continue
+		return False
+
+	def run(self):
+		bucket = None
+		while not self.stop.is_set():
+			try:
+				index, shard = self.tasks.get_nowait()
+			except Empty:
+				return
+			queue = self.queues(index)
+			try:
+				if bucket is None:
+					bucket = self.bucket_factory()
+				for page in shard_pages(bucket, self.prefix, shard):
+					if not self.put(queue, (index, page)):
+						return
+				self.put(queue, (index, _DONE))
+			except Exception:
+				# Every shard has to end with either _DONE or a failure,
+				# or the reader would wait on it forever.
+				self.put(queue, (index, _Failure(sys.exc_info())))
+
+def list_shards(bucket_factory, prefix, shards, threads=DEFAULT_THREADS,
+		ordered=True):
+	"""
+	Generator that lists the given shards concurrently and yields their
+	keys.
+
+	:type bucket_factory: callable
+	:param bucket_factory: Called with no arguments once per listing
+	                       thread, returns a boto.s3.bucket.Bucket on a
+	                       connection of its own.
+
+	:type ordered: bool
+	:param ordered: When True, keys are yielded in the same order as
+	                bucket.list() would yield them.  When False, keys are
+	                yielded as soon as any shard produces them.
+	"""
+	tasks = Queue()
+	for index, shard in enumerate(shards):
+		tasks.put((index, shard))
+	if ordered:
+		shard_queues = [Queue(QUEUE_PAGES) for _ in shards]
+		queues = shard_queues.__getitem__
+	else:
+		shared = Queue(QUEUE_PAGES * threads)
+		queues = lambda index: shared
+	stop = threading.Event()
+	for _ in range(min(threads, len(shards))):
+		ShardLister(bucket_factory, prefix, tasks, queues, stop).start()
+
+	try:
+		remaining = len(shards)
+		current = 0
+		while remaining > 0:
+			_, page = queues(current).get()
+			if page is _DONE:
+				remaining -= 1
+				current += 1 if ordered else 0
+				continue
+			if isinstance(page, _Failure):
+				raise page.exc_info[0], page.exc_info[1], page.exc_info[2]
+			for key in page:
+				yield key
+	finally:
+		stop.set()
+
+def bucket_factory(creds, bucket_name, ordinary=False):
+	"""
+	Returns a function that opens a new connection and returns the named
+	bucket on it, for use with list_shards().
+	"""
+	def factory():
+		conn = k.aws.s3.connect(creds, bucket_name=bucket_name,
+			ordinary=ordinary)
+		return conn.get_bucket(bucket_name, validate=False)
+	return factory
+
+def parallel_list(creds, bucket_name, prefix=None, ordinary=False,
+		threads=DEFAULT_THREADS, ordered=True, delimiter='/'):
+	"""
+	Generator that yields every key under prefix in the bucket, listing
+	disjoint shards of the keyspace concurrently.
+
+	creds: a set of creds that can be used by k.aws.s3.connect
+	bucket_name: string, name of the bucket to list
+	prefix: string or None, only list keys that start with this
+	ordinary: boolean, whether the "ordinary" calling format will be used
+	threads: int, number of concurrent listing connections
+	ordered: boolean, if False keys are yielded in no particular order
+	delimiter: string, the delimiter used to discover the keyspace shape
+	"""
+	factory = bucket_factory(creds, bucket_name, ordinary)
+	shards = plan_shards(factory(), prefix, threads * SHARDS_PER_THREAD,
+		delimiter)
+	logging.info("parallel_list: listing {0} shards of {1}:{2}".format(
+		len(shards), bucket_name, prefix))
+	return list_shards(factory, prefix, shards, threads, ordered)
+
+def list_keys(creds, bucket_name, prefix=None, ordinary=False, threads=1,
+		ordered=True):
+	"""
+	List the keys under prefix, concurrently when threads is more than 1,
+	and with a single bucket.list() otherwise.
+	"""
+	if threads > 1:
+		return parallel_list(creds, bucket_name, prefix, ordinary, threads,
+			ordered)
+	return bucket_factory(creds, bucket_name, ordinary)().list(prefix or '')
+
+def last_key(bucket, prefix='', delimiter='/'):
+	"""
+	Return the lexically last key under prefix (the one bucket.list()
+	would yield last), or None if there are no keys under it.
+
+	Rather than listing every key, this walks down the delimiter
+	hierarchy, listing one level at a time and descending into the last
+	common prefix of each level.  For time partitioned layouts such as
+	YYYY/MM/DD/HH that is a handful of small listings, and only the last
+	level (or a flat prefix) is scanned in full.
+
+	A page holds all of its keys before all of its common prefixes, so
+	the last item of a level is the one with the largest name, not the
+	last one on its last page.
+	"""
+	prefix = prefix or ''
+	while True:
+		last = None
+		marker = ''
+		while True:
+			rs = get_page(bucket, prefix, marker, delimiter)
+			items = list(rs)
+			if items:
+				page_last = max(items, key=lambda item: item.name)
+				if last is None or page_last.name > last.name:
+					last = page_last
+			if not rs.is_truncated or not items:
+				break
+			marker = getattr(rs, 'next_marker', None) or page_last.name
+		if not isinstance(last, Prefix):
+			return last
+		# Every key at this level that isn't under the last common prefix
+		# sorts before it, and so before all of the keys under it.
+		prefix = last.name
+
+def prefetch(iterable, pages=QUEUE_PAGES):
+	"""
+	Generator that yields the items of iterable, which is consumed in a
+	background thread up to pages * PAGE_SIZE items ahead of the reader.
+	Wrapping two listings in prefetch() fetches them at the same time.
+	"""
+	queue = Queue(pages)
+	stop = threading.Event()
+
+	def put(item):
+		while not stop.is_set():
+			try:
+				queue.put(item, timeout=0.5)
+				return True
+			except Full:
+				continue
+		return False
+
+	def run():
+		try:
+			page = []
+			for item in iterable:
+				page.append(item)
+				if len(page) >= PAGE_SIZE:
+					if not put(page):
+						return
+					page = []
+			if page:
+				put(page)
+			put(_DONE)
+		except Exception:
+			put(_Failure(sys.exc_info()))
+
+	thread = threading.Thread(target=run)
+	thread.daemon = True
+	thread.start()
+	try:
+		while True:
+			page = queue.get()
+			if page is _DONE:
+				return
+			if isinstance(page, _Failure):
+				raise page.exc_info[0], page.exc_info[1], page.exc_info[2]
+			for item in page:
+				yield item
+	finally:
+		stop.set()
+
+def merge_listings(src, dst, src_prefix=None, dst_prefix=None,
+		compare_etag=False, include_matches=False):
+	"""
+	Generator that walks two sorted listings side by side (a merge join)
+	and yields a ListingDifference for each key that differs.  Memory use
+	doesn't depend on the size of the listings.
+
+	Key names are compared with src_prefix and dst_prefix stripped off,
+	so "foo/some_key" in the source matches "bar/some_key" in the
+	destination when the prefixes are "foo/" and "bar/".  The kind of a
+	difference is one of:
+
+	 * "missing": the key is only in src (dst is None)
+	 * "extra": the key is only in dst (src is None)
+	 * "mismatch": the key is in both, with a different size (or ETag,
+	   when compare_etag is True)
+	 * "match": the key is the same in both, only when include_matches
+	   is True
+
+	:type src: iterable of boto.s3.key.Key
+	:param src: listing in bucket.list() order, e.g. from parallel_list()
+	"""
+	src_skip = len(src_prefix or '')
+	dst_skip = len(dst_prefix or '')
+	src, dst = iter(src), iter(dst)
+	src_key, dst_key = next(src, None), next(dst, None)
+	while src_key is not None or dst_key is not None:
+		if src_key is not None:
+			src_name = src_key.name[src_skip:]
+		if dst_key is not None:
+			dst_name = dst_key.name[dst_skip:]
+		if dst_key is None or (src_key is not None and src_name < dst_name):
+			yield ListingDifference('missing', src_name, src_key, None)
+			src_key = next(src, None)
+		elif src_key is None or dst_name < src_name:
+			yield ListingDifference('extra', dst_name, None, dst_key)
+			dst_key = next(dst, None)
+		else:
+			same = src_key.size == dst_key.size
+			if same and compare_etag:
+				same = (src_key.etag or '').strip('"') == (dst_key.etag or '').strip('"')
+			if not same:
+				yield ListingDifference('mismatch', src_name, src_key, dst_key)
+			elif include_matches:
+				yield ListingDifference('match', src_name, src_key, dst_key)
+			src_key, dst_key = next(src, None), next(dst, None)
+
+def get_listing_options(parser):
+	"""
+	Add the --list-threads option to the option parser.
+
+	:param parser: option parser
+	:type parser: optparse.OptionParser
+
+	:rtype: optparse.OptionParser
+	"""
+	parser.add_option(
+		"--list-threads", dest="list_threads", type="int", default=1,
+		help=' '.join(["List the bucket over this many concurrent",
+			"connections (Default: 1)"]))
+	return parser
+
+# Local Variables:
+# tab-width: 4
+# indent-tabs-mode: t
+# End:
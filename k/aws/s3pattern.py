@@ -0,0 +1,239 @@
+"""Glob and regex filters on s3 key names that narrow the listing.
+
+s3 can only filter a listing by a literal prefix, so filtering keys on a
+pattern means listing everything the pattern could match and checking
+each name.  A KeyPattern works out, from the pattern itself, the
+smallest set of literal prefixes that every matching key must start
+with: the literal start of the pattern, expanded over alternatives
+({a,b} or a|b) and small character classes ([0-3]).  Only those prefixes
+are listed, so logs/2014/0[1-3]/*/12-* lists three prefixes, not the
+whole bucket.
+
+Globs match the whole key name:
+
+ * ``*`` matches any run of characters other than "/"
+ * ``**`` matches any run of characters, including "/"
+ * ``?`` matches any one character other than "/"
+ * ``[abc]``, ``[a-z]`` and ``[!abc]`` match one character of a set
+ * ``{a,b}`` matches either alternative, and may be nested
+
+Regexes are matched from the start of the key name, as re.match() does,
+so that a literal prefix can be read off of them.
+
+Patterns given as byte strings are taken to be UTF-8, and are decoded
+before they're translated or compiled, since boto's key names are
+unicode.
+
+Example:
+
+    pattern = k.aws.s3pattern.compile_glob("logs/2014/0[1-3]/*/12-*")
+    for key in pattern.keys(bucket):
+        print key.name
+"""
+
+import logging
+import re
+import sre_constants
+import sre_parse
+
+#: Most prefixes a pattern is expanded into.  Alternatives that would
+#: go past this are listed under their common prefix instead.
+MAX_PREFIXES = 256
+#: Largest character class expanded into separate prefixes.
+MAX_CLASS_SIZE = 64
+
+def _decode(pattern):
+	if isinstance(pattern, bytes):
+		return pattern.decode('utf-8')
+	return pattern
+
+def glob_to_regex(pattern):
+	"""Translate a glob (see the module documentation) to a regex"""
+	pattern = _decode(pattern)
+	out = []
+	depth = 0
+	i, n = 0, len(pattern)
+	while i < n:
+		c = pattern[i]
+		i += 1
+		if c == '*':
+			if pattern[i:i + 1] == '*':
+				i += 1
+				out.append('.*')
+			else:
+				out.append('[^/]*')
+		elif c == '?':
+			out.append('[^/]')
+		elif c == '[':
+			j = i
+			if pattern[j:j + 1] in ('!', '^'):
+				j += 1
+			if pattern[j:j + 1] == ']':
+				j += 1
+			j = pattern.find(']', j)
+			if j < 0:
+				out.append(re.escape(c))
+				continue
+			chars = pattern[i:j].replace('\\', '\\\\')
+			if chars[:1] in ('!', '^'):
+				chars = '^' + chars[1:]
+			out.append('[' + chars + ']')
+			i = j + 1
+		elif c == '{':
+			depth += 1
+			out.append('(?:')
+		elif c == ',' and depth:
+			out.append('|')
+		elif c == '}' and depth:
+			depth -= 1
+			out.append(')')
+		else:
+			out.append(re.escape(c))
+	if depth:
+		raise ValueError("Unbalanced braces in glob {0!r}".format(pattern))
+	return ''.join(out) + r'\Z'
+
+def _class_chars(items):
+	"""The characters a parsed [...] class matches, or None if too many"""
+	chars = []
+	for op, av in items:
+		if op == sre_constants.LITERAL:
+			chars.append(av)
+		elif op == sre_constants.RANGE:
+			low, high = av
+			if high - low >= MAX_CLASS_SIZE:
+				return None
+			chars.extend(range(low, high + 1))
+		else:
+			return None
+		if len(chars) > MAX_CLASS_SIZE:
+			return None
+	return [unichr(char) for char in sorted(set(chars))]
+
+def _expand(items, prefixes, limit):
+	"""
+	Extend prefixes over the literal start of a parsed regex.  Returns
+	the new prefixes and whether all of items was literal, in which case
+	whatever follows items may extend them further.
+	"""
+	for op, av in items:
+		if op == sre_constants.LITERAL:
+			prefixes = [prefix + unichr(av) for prefix in prefixes]
+		elif op == sre_constants.IN:
+			chars = _class_chars(av)
+			if chars is None or len(prefixes) * len(chars) > limit:
+				return prefixes, False
+			prefixes = [prefix + char for prefix in prefixes for char in chars]
+		elif op == sre_constants.SUBPATTERN:
+			prefixes, complete = _expand(av[-1], prefixes, limit)
+			if not complete:
+				return prefixes, False
+		elif op == sre_constants.BRANCH:
+			expanded = []
+			complete = True
+			for branch in av[1]:
+				branch_prefixes, branch_complete = _expand(branch, prefixes, limit)
+				expanded.extend(branch_prefixes)
+				complete = complete and branch_complete
+			if len(expanded) > limit:
+				return prefixes, False
+			prefixes = expanded
+			if not complete:
+				return prefixes, False
+		elif op == sre_constants.AT and av == sre_constants.AT_BEGINNING:
+			continue
+		else:
+			return prefixes, False
+	return prefixes, True
+
+def minimize_prefixes(prefixes):
+	"""
+	Sort prefixes and drop any that start with another of them, so that
+	listing each in turn lists every key once, in bucket.list() order.
+	"""
+	kept = []
+	for prefix in sorted(set(prefixes)):
+		if not kept or not prefix.startswith(kept[-1]):
+			kept.append(prefix)
+	return kept
+
+def literal_prefixes(regex, limit=MAX_PREFIXES):
+	"""
+	The sorted literal prefixes that any key name matched (with
+	re.match()) by regex must start with.  Returns [''] when nothing
+	narrower can be worked out.
+	"""
+	parsed = sre_parse.parse(_decode(regex))
+	state = getattr(parsed, 'state', None) or getattr(parsed, 'pattern', None)
+	if getattr(state, 'flags', 0) & sre_constants.SRE_FLAG_IGNORECASE:
+		return ['']
+	prefixes, _ = _expand(parsed, [''], limit)
+	return minimize_prefixes(prefixes)
+
+class KeyPattern(object):
+	"""
+	A compiled key name filter, with the literal prefixes that have to
+	be listed to find every key it matches.
+	"""
+	def __init__(self, regex, source=None):
+		regex = _decode(regex)
+		self.source = source or regex
+		self.regex = re.compile(regex)
+		self.prefixes = literal_prefixes(regex)
+
+	def match(self, name):
+		return self.regex.match(name) is not None
+
+	def keys(self, bucket):
+		"""
+		Generator that yields the keys in the bucket matching the
+		pattern, in bucket.list() order.
+		"""
+		logging.info("KeyPattern.keys: listing {0} prefixes for {1}".format(
+			len(self.prefixes), self.source))
+		for prefix in self.prefixes:
+			for key in bucket.list(prefix=prefix):
+				if self.match(key.name):
+					yield key
+
+def compile_glob(pattern):
+	return KeyPattern(glob_to_regex(pattern), _decode(pattern))
+
+def compile_regex(regex):
+	return KeyPattern(regex)
+
+def get_key_pattern(options):
+	"""
+	The KeyPattern given by --glob or --regex, or None if neither was.
+	"""
+	if options.glob and options.regex:
+		raise ValueError("Only one of --glob and --regex can be given")
+	if options.glob:
+		return compile_glob(options.glob)
+	if options.regex:
+		return compile_regex(options.regex)
+	return None
+
+def get_pattern_options(parser):
+	"""
+	Add the --glob and --regex options to the option parser.
+
+	:param parser: option parser
+	:type parser: optparse.OptionParser
+
+	:rtype: optparse.OptionParser
+	"""
+	parser.add_option(
+		"--glob", dest="glob", default=None,
+		help=' '.join(["Only keys whose whole name matches this glob,",
+			"e.g. 'logs/2014/0[1-3]/*/12-*' ('**' crosses '/', {a,b} is",
+			"either)"]))
+	parser.add_option(
+		"--regex", dest="regex", default=None,
+		help="Only keys whose name, from the start, matches this regex")
+	return parser
+
+# Local Variables:
+# tab-width: 4
+# indent-tabs-mode: t
+# End:
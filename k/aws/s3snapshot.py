@@ -0,0 +1,314 @@
+"""Persistent local snapshots of s3 bucket listings.
+
+Tools like s3-list, s3-describe-bucket and s3-compare-listings tend to
+be run back to back against the same bucket, and each run re-lists the
+bucket from scratch.  A snapshot is an indexed SQLite file, one per
+bucket and prefix, under ~/.k.aws/snapshots, holding the name, size,
+ETag, last modified time and storage class of every key.
+
+A snapshot is split into the same disjoint shards that
+k.aws.s3listing lists concurrently, and each shard remembers when it
+was last listed.  Refreshing a snapshot re-lists only the shards that
+are older than the requested maximum age (and that overlap the prefix
+being asked about), so repeated queries are answered locally.
+
+Example:
+
+    keys = k.aws.s3snapshot.snapshot_keys(creds, "some-bucket", "logs/",
+        max_age=3600, substring="error")
+    for key in keys:
+        print key.name, key.size
+"""
+
+import hashlib
+import logging
+import os
+import os.path
+import sys
+import time
+from collections import namedtuple
+import k.aws.s3listing
+from k.aws.config import K_AWS_PATH
+
+SNAPSHOT_PATH = os.path.join(K_AWS_PATH, 'snapshots')
+#: Shards a new snapshot is split into.  Staleness is tracked, and
+#: refreshes happen, a shard at a time.
+SNAPSHOT_SHARDS = 64
+DEFAULT_MAX_AGE = 3600
+INSERT_BATCH = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS keys (
+	name TEXT PRIMARY KEY,
+	size INTEGER,
+	etag TEXT,
+	last_modified TEXT,
+	storage_class TEXT
+);
+CREATE INDEX IF NOT EXISTS keys_size ON keys (size);
+CREATE TABLE IF NOT EXISTS shards (
+	id INTEGER PRIMARY KEY,
+	marker TEXT,
+	upper TEXT,
+	refreshed REAL
+);
+CREATE TABLE IF NOT EXISTS meta (
+	name TEXT PRIMARY KEY,
+	value TEXT
+);
+"""
+
+SnapshotKey = namedtuple('SnapshotKey',
+	['name', 'size', 'etag', 'last_modified', 'storage_class'])
+
+SnapshotShard = namedtuple('SnapshotShard', ['id', 'marker', 'end', 'refreshed'])
+
+def snapshot_path(bucket_name, prefix=''):
+	"""Path of the snapshot file for a bucket and prefix"""
+	digest = hashlib.sha1((prefix or '').encode('utf-8')).hexdigest()[:16]
+	return os.path.join(SNAPSHOT_PATH, bucket_name, digest + ".db")
+
+def prefix_upper_bound(prefix):
+	"""
+	The smallest string that sorts after every string starting with
+	prefix, or None if there isn't one.
+	"""
+	while prefix:
+		last = ord(prefix[-1])
+		if last < sys.maxunicode:
+			return prefix[:-1] + unichr(last + 1)
+		prefix = prefix[:-1]
+	return None
+
+def shard_overlaps_prefix(shard, prefix):
+	"""Whether any key starting with prefix falls in the shard"""
+	if not prefix:
+		return True
+	upper = prefix_upper_bound(prefix)
+	if shard.marker is not None and upper is not None and shard.marker >= upper:
+		return False
+	if shard.end is not None and shard.end < prefix:
+		return False
+	return True
+
+def _range_clause(marker, end):
+	clauses, args = [], []
+	if marker is not None:
+		clauses.append("name > ?")
+		args.append(marker)
+	if end is not None:
+		clauses.append("name <= ?")
+		args.append(end)
+	return clauses, args
+
+def _where(clauses):
+	if not clauses:
+		return ""
+	return " WHERE " + " AND ".join(clauses)
+
+def _row(key):
+	return (key.name, key.size, key.etag, key.last_modified,
+		getattr(key, 'storage_class', None))
+
+class Snapshot(object):
+	"""
+	A local, indexed copy of the listing of a bucket under a prefix.
+	"""
+	def __init__(self, bucket_name, prefix='', path=None):
+		self.bucket_name = bucket_name
+		self.prefix = prefix or ''
+		self.path = path or snapshot_path(bucket_name, self.prefix)
+		directory = os.path.dirname(self.path)
+		if not os.path.exists(directory):
+			os.makedirs(directory, 0700)
+		import sqlite3
+		self.db = sqlite3.connect(self.path, timeout=60)
+		self.db.execute("PRAGMA case_sensitive_like = ON")
+		self.db.executescript(SCHEMA)
+		self.db.execute("INSERT OR REPLACE INTO meta VALUES ('prefix', ?)",
+			(self.prefix,))
+		self.db.commit()
+
+	def close(self):
+		self.db.close()
+
+	def shards(self):
+		rows = self.db.execute(
+			"SELECT id, marker, upper, refreshed FROM shards ORDER BY id")
+		return [SnapshotShard(*row) for row in rows]
+
+	def set_shards(self, shards):
+		"""Replace the shard plan, which marks every shard as stale"""
+		self.db.execute("DELETE FROM shards")
+		self.db.executemany(
+			"INSERT INTO shards (id, marker, upper, refreshed) VALUES (?, ?, ?, NULL)",
+			[(index, marker, end) for index, (marker, end) in enumerate(shards)])
+		self.db.commit()
+
+	def stale_shards(self, max_age, prefix=None):
+		"""Shards overlapping prefix that were listed over max_age seconds ago"""
+		oldest = time.time() - max_age
+		return [shard for shard in self.shards()
+			if (shard.refreshed is None or shard.refreshed < oldest)
+			and shard_overlaps_prefix(shard, prefix)]
+
+	def refresh(self, bucket_factory, max_age=DEFAULT_MAX_AGE,
+			threads=k.aws.s3listing.DEFAULT_THREADS, prefix=None):
+		"""
+		Re-list every shard that overlaps prefix and is older than max_age
+		seconds, concurrently.  Returns the number of shards re-listed.
+
+		:type bucket_factory: callable
+		:param bucket_factory: as for k.aws.s3listing.list_shards()
+		"""
+		if not self.shards():
+			self.set_shards(k.aws.s3listing.plan_shards(
+				bucket_factory(), self.prefix, SNAPSHOT_SHARDS))
+		stale = self.stale_shards(max_age, prefix)
+		if not stale:
+			return 0
+		logging.info("Snapshot.refresh: re-listing {0} of {1} shards of {2}:{3}".format(
+			len(stale), len(self.shards()), self.bucket_name, self.prefix))
+		keys = k.aws.s3listing.list_shards(bucket_factory, self.prefix,
+			[(shard.marker, shard.end) for shard in stale], threads)
+		self._store(stale, keys)
+		return len(stale)
+
+	def _store(self, shards, keys):
+		"""
+		Replace the contents of each of the (sorted) shards with the keys,
+		which must arrive in order.  Each shard is committed on its own,
+		so an interrupted refresh leaves the finished shards fresh.
+		"""
+		shards = iter(shards)
+		current = next(shards)
+		self._clear(current)
+		batch = []
+		for key in keys:
+			while current.end is not None and key.name > current.end:
+				self._insert(batch)
+				batch = []
+				self._finish(current)
+				current = next(shards)
+				self._clear(current)
+			batch.append(_row(key))
+			if len(batch) >= INSERT_BATCH:
+				self._insert(batch)
+				batch = []
+		self._insert(batch)
+		self._finish(current)
+		for shard in shards:
+			self._clear(shard)
+			self._finish(shard)
+
+	def _clear(self, shard):
+		clauses, args = _range_clause(shard.marker, shard.end)
+		self.db.execute("DELETE FROM keys" + _where(clauses), args)
+
+	def _insert(self, rows):
+		if rows:
+			self.db.executemany(
+				"INSERT OR REPLACE INTO keys VALUES (?, ?, ?, ?, ?)", rows)
+
+	def _finish(self, shard):
+		self.db.execute("UPDATE shards SET refreshed = ? WHERE id = ?",
+			(time.time(), shard.id))
+		self.db.commit()
+
+	def _query(self, select, prefix=None, substring=None, min_size=None,
+			max_size=None, order=""):
+		clauses, args = [], []
+		if prefix:
+			clauses.append("name >= ?")
+			args.append(prefix)
+			upper = prefix_upper_bound(prefix)
+			if upper is not None:
+				clauses.append("name < ?")
+				args.append(upper)
+		if substring:
+			escaped = substring.replace('\\', '\\\\').replace(
+				'%', '\\%').replace('_', '\\_')
+			clauses.append("name LIKE ? ESCAPE '\\'")
+			args.append('%' + escaped + '%')
+		if min_size is not None:
+			clauses.append("size >= ?")
+			args.append(min_size)
+		if max_size is not None:
+			clauses.append("size <= ?")
+			args.append(max_size)
+		return self.db.execute(select + _where(clauses) + order, args)
+
+	def keys(self, prefix=None, substring=None, min_size=None, max_size=None):
+		"""
+		Generator that yields a SnapshotKey for every key in the snapshot
+		matching all of the given filters, in bucket.list() order.
+		"""
+		rows = self._query(
+			"SELECT name, size, etag, last_modified, storage_class FROM keys",
+			prefix, substring, min_size, max_size, " ORDER BY name")
+		for row in rows:
+			yield SnapshotKey(*row)
+
+	def summary(self, prefix=None, substring=None, min_size=None,
+			max_size=None):
+		"""Returns the (count, total size) of the matching keys"""
+		count, total = self._query("SELECT count(*), sum(size) FROM keys",
+			prefix, substring, min_size, max_size).fetchone()
+		return count, total or 0
+
+def open_snapshot(bucket_name, prefix=None):
+	"""
+	Open the snapshot of the closest ancestor of prefix (at a '/') that
+	already has one, or a new snapshot of prefix itself.
+	"""
+	prefix = prefix or ''
+	candidates = [prefix]
+	candidates.extend(prefix[:index + 1]
+		for index in reversed(range(len(prefix) - 1)) if prefix[index] == '/')
+	candidates.append('')
+	for candidate in candidates:
+		if os.path.exists(snapshot_path(bucket_name, candidate)):
+			return Snapshot(bucket_name, candidate)
+	return Snapshot(bucket_name, prefix)
+
+def snapshot_keys(creds, bucket_name, prefix=None, ordinary=False,
+		max_age=DEFAULT_MAX_AGE, threads=k.aws.s3listing.DEFAULT_THREADS,
+		substring=None, min_size=None, max_size=None):
+	"""
+	Generator that yields the keys under prefix from the local snapshot,
+	after re-listing any part of it older than max_age seconds.
+
+	creds: a set of creds that can be used by k.aws.s3.connect
+	bucket_name: string, name of the bucket to list
+	prefix: string or None, only yield keys that start with this
+	ordinary: boolean, whether the "ordinary" calling format will be used
+	max_age: int, seconds a shard of the snapshot is trusted for
+	threads: int, number of concurrent connections used to refresh
+	substring, min_size, max_size: further filters on the keys
+	"""
+	snapshot = open_snapshot(bucket_name, prefix)
+	snapshot.refresh(
+		k.aws.s3listing.bucket_factory(creds, bucket_name, ordinary),
+		max_age, threads, prefix)
+	return snapshot.keys(prefix, substring, min_size, max_size)
+
+def get_snapshot_options(parser):
+	"""
+	Add the --max-age option to the option parser.
+
+	:param parser: option parser
+	:type parser: optparse.OptionParser
+
+	:rtype: optparse.OptionParser
+	"""
+	parser.add_option(
+		"--max-age", dest="max_age", type="int", default=None,
+		help=' '.join(["Answer from the local listing snapshot in",
+			SNAPSHOT_PATH + ",", "re-listing the parts of it that are older",
+			"than this many seconds"]))
+	return parser
+
+# Local Variables:
+# tab-width: 4
+# indent-tabs-mode: t
+# End:
@@ -0,0 +1,178 @@
+"""Streaming usage summaries ("du") of s3 bucket listings.
+
+A Usage rolls a listing up, one key at a time, into key counts and total
+sizes by prefix (down to a fixed depth of delimiters), by storage class
+and by age.  Keys are not kept, so memory use depends only on the number
+of distinct prefixes, which is capped at max_nodes; prefixes past the
+cap are still counted in their ancestors.
+
+For buckets too big to list in full, sample_keys() lists a random subset
+of the listing shards planned by k.aws.s3listing, and the summary is
+scaled up by the fraction sampled.  Shards aren't all the same size, so
+this is an estimate; more shards make for a better one.
+
+Example:
+
+    usage = k.aws.s3usage.Usage("logs/", depth=2)
+    usage.add_all(k.aws.s3listing.parallel_list(creds, "some-bucket",
+        "logs/", ordered=False))
+    for level, name, count, size in usage.tree():
+        print "  " * level, name, count, size
+"""
+
+import calendar
+import random
+import time
+from collections import defaultdict
+import k.aws.s3listing
+
+DEFAULT_DEPTH = 2
+#: Most prefixes a Usage will track before it stops descending.
+MAX_NODES = 10000
+#: Shards planned when sampling a listing.
+SAMPLE_SHARDS = 256
+DAY = 24 * 60 * 60
+#: Upper bounds (in seconds) and labels of the age buckets.  Keys older
+#: than the last bound are counted as OLDER.
+AGE_BUCKETS = [
+	(DAY, "1 day"),
+	(7 * DAY, "1 week"),
+	(30 * DAY, "30 days"),
+	(90 * DAY, "90 days"),
+	(365 * DAY, "1 year"),
+]
+OLDER = "older"
+UNKNOWN = "unknown"
+
+def parse_timestamp(last_modified):
+	"""
+	Seconds since the epoch of a listing's last_modified value
+	("2014-01-01T00:00:00.000Z"), or None if it can't be parsed.
+	"""
+	try:
+		return calendar.timegm(time.strptime(last_modified[:19],
+			"%Y-%m-%dT%H:%M:%S"))
+	except (TypeError, ValueError):
+		return None
+
+def age_bucket(age):
+	"""The label of the AGE_BUCKETS bucket for an age in seconds"""
+	if age is None:
+		return UNKNOWN
+	for bound, label in AGE_BUCKETS:
+		if age < bound:
+			return label
+	return OLDER
+
+class Usage(object):
+	"""
+	Counts and sizes of the keys under a prefix, rolled up by prefix,
+	storage class and age.  Every total is a [count, size] list.
+	"""
+	def __init__(self, prefix='', depth=DEFAULT_DEPTH, delimiter='/',
+			max_nodes=MAX_NODES, now=None):
+		self.prefix = prefix or ''
+		self.depth = depth
+		self.delimiter = delimiter
+		self.max_nodes = max_nodes
+		self.now = now or time.time()
+		self.scale = 1.0
+		self.truncated = False
+		self.total = [0, 0]
+		self.prefixes = {}
+		self.storage_classes = defaultdict(lambda: [0, 0])
+		self.ages = defaultdict(lambda: [0, 0])
+		# Ages are worked out to the hour, once per hour seen
+		self._age_cache = {}
+
+	def _count(self, totals, size):
+		totals[0] += 1
+		totals[1] += size
+
+	def add(self, key):
+		size = key.size or 0
+		self._count(self.total, size)
+		self._count(self.storage_classes[
+			getattr(key, 'storage_class', None) or 'STANDARD'], size)
+		hour = (key.last_modified or '')[:13]
+		label = self._age_cache.get(hour)
+		if label is None:
+			timestamp = parse_timestamp(hour + ":00:00")
+			label = age_bucket(None if timestamp is None else self.now - timestamp)
+			self._age_cache[hour] = label
+		self._count(self.ages[label], size)
+		if self.depth < 1:
+			return
+		parts = key.name[len(self.prefix):].split(self.delimiter, self.depth)
+		node = self.prefix
+		for part in parts[:-1]:
+			node += part + self.delimiter
+			totals = self.prefixes.get(node)
+			if totals is None:
+				if len(self.prefixes) >= self.max_nodes:
+					self.truncated = True
+					return
+				totals = self.prefixes[node] = [0, 0]
+			self._count(totals, size)
+
+	def add_all(self, keys):
+		for key in keys:
+			self.add(key)
+		return self
+
+	def scaled(self, totals):
+		"""(count, size) of a [count, size] total, scaled up when sampled"""
+		if self.scale == 1.0:
+			return totals[0], totals[1]
+		return int(round(totals[0] * self.scale)), int(round(totals[1] * self.scale))
+
+	def tree(self):
+		"""
+		Generator that yields (level, prefix, count, size) for the prefix
+		itself (level 0) and then for each prefix under it, depth first in
+		key order.
+		"""
+		count, size = self.scaled(self.total)
+		yield 0, self.prefix, count, size
+		for node in sorted(self.prefixes):
+			level = node[len(self.prefix):].count(self.delimiter)
+			count, size = self.scaled(self.prefixes[node])
+			yield level, node, count, size
+
+	def as_dict(self):
+		"""The whole summary, as a structure that can be dumped as json"""
+		def totals(table):
+			return dict((name, dict(zip(('count', 'size'), self.scaled(value))))
+				for name, value in table.iteritems())
+		count, size = self.scaled(self.total)
+		return {
+			"prefix": self.prefix,
+			"depth": self.depth,
+			"count": count,
+			"size": size,
+			"approximate": self.scale != 1.0,
+			"truncated": self.truncated,
+			"prefixes": totals(self.prefixes),
+			"storage-classes": totals(self.storage_classes),
+			"ages": totals(self.ages),
+		}
+
+def sample_keys(creds, bucket_name, prefix=None, ordinary=False, fraction=0.1,
+		threads=k.aws.s3listing.DEFAULT_THREADS, shards=SAMPLE_SHARDS):
+	"""
+	List a random fraction of the shards under prefix.  Returns the keys
+	(a generator, in no particular order) and the factor that sums over
+	them should be scaled up by.
+	"""
+	factory = k.aws.s3listing.bucket_factory(creds, bucket_name, ordinary)
+	planned = k.aws.s3listing.plan_shards(factory(), prefix, shards)
+	wanted = min(len(planned), max(1, int(round(len(planned) * fraction))))
+	chosen = sorted(random.sample(range(len(planned)), wanted))
+	keys = k.aws.s3listing.list_shards(factory, prefix,
+		[planned[index] for index in chosen], threads, ordered=False)
+	return keys, len(planned) / float(wanted)
+
+# Local Variables:
+# tab-width: 4
+# indent-tabs-mode: t
+# End:
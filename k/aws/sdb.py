@@ -1,10 +1,11 @@
 import os
 import sys
 import boto
-import boto.sdb
-from k.aws.config import AwsCreds, connection_hash
+from k.aws.config import AwsCreds, connection_hash, register_connection
 from k.aws.config import RegionAwsCreds, region_connection_hash
+from k.aws.connections import pooled
 
+@pooled("sdb")
 def connect(creds):
 	"""
 	Connect to simple db, with user-provided options.
@@ -15,10 +16,12 @@ def connect(creds):
 	:rtype: boto.sdb.connection.SDBConnection.
 	"""
 	if isinstance(creds, AwsCreds):
-		return boto.connect_sdb(**connection_hash(creds))
+		return register_connection(creds,
+			boto.connect_sdb(**connection_hash(creds)))
 	elif isinstance(creds, RegionAwsCreds):
-		return boto.sdb.connect_to_region(
-			**region_connection_hash(creds))
+		from boto.sdb import connect_to_region
+		return register_connection(creds,
+			connect_to_region(**region_connection_hash(creds)))
 	raise Exception("Unrecognized credential type: %s" % creds)
 
 def get_sdb_options(parser):
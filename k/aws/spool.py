@@ -0,0 +1,170 @@
+"""Watching spool directories for new files.
+
+gzip-respooler and s3-spooling-sender both drain a directory that other
+processes drop files into.  Rather than re-reading the directory after
+every file, watch() lists it once, hands the sorted snapshot to the
+caller to work through, and only lists it again once the caller is
+done.  Between snapshots it waits for the kernel to say that a file was
+finished (inotify IN_CLOSE_WRITE) or moved in (IN_MOVED_TO), so an idle
+daemon is asleep rather than polling.  Where inotify isn't available it
+falls back to polling at a fixed interval.  Dotfiles are never listed.
+
+Example:
+
+    for files in k.aws.spool.watch("/var/spool/logs", interval=0.1):
+        for name in files:
+            process(name)
+        if not files:
+            check_timeouts()
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import sys
+import time
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 00004000
+IN_CLOEXEC = 02000000
+#: Longest a watcher waits for an event before letting the caller do
+#: its idle work (checking timeouts and such).
+IDLE_TICK = 1.0
+DEFAULT_INTERVAL = 0.1
+
+def list_spool(directory):
+	"""
+	The sorted paths of the files in a spool directory.  Dotfiles are
+	left out, so that daemons can keep their own state in the directory.
+	"""
+	return [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+		if not name.startswith('.')]
+
+def backlog(directory, now=None):
+	"""
+	(files, bytes, age) of the backlog in a spool directory: how many files
+	are waiting, their total size, and the age in seconds of the oldest
+	(0 when there are none).  Files removed while being looked at are
+	skipped.
+	"""
+	if now is None:
+		now = time.time()
+	count = size = 0
+	oldest = now
+	for path in list_spool(directory):
+		try:
+			stat = os.stat(path)
+		except OSError as err:
+			if err.errno == errno.ENOENT:
+				continue
+			raise
+		count += 1
+		size += stat.st_size
+		oldest = min(oldest, stat.st_mtime)
+	return count, size, max(0, now - oldest)
+
+class PollingWatcher(object):
+	"""Waits a fixed interval, for when inotify isn't available"""
+	def __init__(self, directory, interval=DEFAULT_INTERVAL):
+		self.directory = directory
+		self.interval = interval
+
+	def wait(self, timeout=None):
+		if timeout is None:
+			timeout = self.interval
+		time.sleep(min(self.interval, timeout))
+		return True
+
+	def close(self):
+		pass
+
+class InotifyWatcher(object):
+	"""
+	Waits for files to be closed after writing, or moved into, a
+	directory.  Raises OSError if inotify can't be set up.
+	"""
+	def __init__(self, directory):
+		self.directory = directory
+		libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+			use_errno=True)
+		if not hasattr(libc, 'inotify_init1'):
+			raise OSError(errno.ENOSYS, "inotify is not available")
+		self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+		path = directory
+		if isinstance(path, unicode):
+			path = path.encode(sys.getfilesystemencoding())
+		if libc.inotify_add_watch(self.fd, path, IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+			err = ctypes.get_errno()
+			os.close(self.fd)
+			raise OSError(err, "inotify_add_watch failed on {0}".format(directory))
+
+	def wait(self, timeout=None):
+		"""
+		Wait up to timeout seconds (forever if None) for events.  Returns
+		whether there were any; the events themselves are discarded since
+		the caller lists the directory anyway.
+		"""
+		readable, _, _ = select.select([self.fd], [], [], timeout)
+		if not readable:
+			return False
+		while True:
+			try:
+				if not os.read(self.fd, 65536):
+					break
+			except OSError as err:
+				if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+					break
+				raise
+		return True
+
+	def close(self):
+		os.close(self.fd)
+
+def get_watcher(directory, interval=DEFAULT_INTERVAL):
+	"""An InotifyWatcher on directory if possible, or a PollingWatcher"""
+	try:
+		return InotifyWatcher(directory)
+	except (OSError, AttributeError) as err:
+		logging.info("get_watcher: polling {0} every {1}s: {2}".format(
+			directory, interval, err))
+		return PollingWatcher(directory, interval)
+
+def watch(directory, interval=DEFAULT_INTERVAL, tick=IDLE_TICK):
+	"""
+	Generator that yields sorted snapshots (lists of paths) of the files
+	in directory.  The next snapshot is only taken once the caller asks
+	for it, so each file is listed once however large the backlog is.
+	When the directory is empty, waits for new files and yields an empty
+	list at least every tick seconds, so that the caller can do idle
+	work.  If a snapshot comes back unchanged (the caller left its files
+	in place) it is retried after a wait, rather than in a tight loop.
+
+	:type interval: float
+	:param interval: Seconds between listings when polling
+	"""
+	watcher = get_watcher(directory, interval)
+	try:
+		unchanged = None
+		while True:
+			files = list_spool(directory)
+			if files and files != unchanged:
+				yield files
+				unchanged = files
+				continue
+			watcher.wait(tick)
+			unchanged = None
+			if not files:
+				yield []
+	finally:
+		watcher.close()
+
+# Local Variables:
+# tab-width: 4
+# indent-tabs-mode: t
+# End:
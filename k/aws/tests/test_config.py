@@ -0,0 +1,102 @@
+import datetime
+import os
+import shutil
+import tempfile
+
+import yaml
+from mock import Mock, patch
+
+import k.aws.config as config_under_test
+
+
+def _write(directory, env, access):
+	with open(os.path.join(directory, env + '.yml'), 'w') as writer:
+		writer.write('access_key: %s\nsecret_key: secret\n' % access)
+
+
+def test_environment_lookup_reads_one_file_and_memoizes():
+	system, override = tempfile.mkdtemp(), tempfile.mkdtemp()
+	try:
+		for env in ('staging', 'production', 'other'):
+			_write(system, env, 'system-' + env)
+		_write(override, 'production', 'override')
+		with patch.object(config_under_test, 'AWS_PATH', system), \
+				patch.object(config_under_test, 'K_AWS_PATH', override), \
+				patch.object(yaml, 'load', wraps=yaml.load) as load:
+			config_under_test._yaml_files.clear()
+			assert config_under_test.get_keys_for_environment('production') == (
+				'override', 'secret')
+			assert config_under_test.get_keys_for_environment('staging') == (
+				'system-staging', 'secret')
+			assert load.call_count == 2
+			config_under_test.get_keys_for_environment('staging')
+			assert load.call_count == 2
+			_write(system, 'staging', 'changed-staging')
+			assert config_under_test.get_keys_for_environment('staging')[0] == (
+				'changed-staging')
+			assert config_under_test._get_aws_conf('missing') is None
+	finally:
+		shutil.rmtree(system)
+		shutil.rmtree(override)
+
+
+def _keys(access, minutes):
+	expiration = datetime.datetime.utcnow() + datetime.timedelta(minutes=minutes)
+	return {'accessKeyId': access, 'secretAccessKey': access + '-secret',
+		'sessionToken': access + '-token',
+		'expiration': expiration.strftime('%Y-%m-%dT%H:%M:%SZ')}
+
+
+def test_provider_shares_cache_and_updates_connections():
+	directory = tempfile.mkdtemp()
+	try:
+		with patch.object(config_under_test, 'K_AWS_PATH', directory), \
+				patch.object(config_under_test.CredentialProvider, '_start'):
+			fetches = [_keys('old', 10), _keys('new', 60)]
+			fetch = Mock(side_effect=fetches)
+			provider = config_under_test.CredentialProvider('role', 'rw', fetch)
+			creds = provider.get()
+			assert (creds.access, creds.token) == ('old', 'old-token')
+			conn = Mock()
+			assert config_under_test.register_connection(creds, conn) is conn
+			# Another process's provider uses the same cache
+			other = Mock(side_effect=AssertionError("the cache wasn't shared"))
+			assert config_under_test.CredentialProvider(
+				'role', 'rw', other).get().access == 'old'
+			provider.refresh(config_under_test.REFRESH_MARGIN)
+			assert fetch.call_count == 2
+			assert conn.provider.access_key == 'new'
+			assert conn.provider.security_token == 'new-token'
+			conn._auth_handler.update_provider.assert_called_once_with(
+				conn.provider)
+			assert provider.get().access == 'new'
+	finally:
+		shutil.rmtree(directory)
+
+
+def test_environment_names_come_from_both_directories():
+	system, override = tempfile.mkdtemp(), tempfile.mkdtemp()
+	try:
+		_write(system, 'staging', 'staging')
+		_write(override, 'production', 'production')
+		_write(override, 'staging', 'staging')
+		with open(os.path.join(override, 'tools.yml'), 'w') as writer:
+			writer.write('variables: {}\n')
+		with open(os.path.join(override, 'keypairs.yml'), 'w') as writer:
+			writer.write('keypairs: {}\n')
+		with patch.object(config_under_test, 'AWS_PATH', system), \
+				patch.object(config_under_test, 'K_AWS_PATH', override):
+			assert config_under_test.get_environment_names() == [
+				'production', 'staging']
+	finally:
+		shutil.rmtree(system)
+		shutil.rmtree(override)
+
+
+def test_box_iam_role_is_looked_up_once():
+	with patch.object(config_under_test, '_box_iam_role', None), \
+			patch.object(config_under_test, 'get_box_iam_role',
+				return_value=None) as get_box_iam_role:
+		assert config_under_test.get_credential_provider() is None
+		assert config_under_test.get_credential_provider() is None
+	assert get_box_iam_role.call_count == 1
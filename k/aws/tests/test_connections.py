@@ -0,0 +1,70 @@
+import threading
+
+from mock import Mock, patch
+
+import k.aws.connections as connections_under_test
+
+
+def _in_thread(function):
+	result = []
+	thread = threading.Thread(target=lambda: result.append(function()))
+	thread.start()
+	thread.join()
+	return result[0]
+
+
+def test_threads_check_out_and_reuse_connections():
+	connections_under_test.clear()
+	factory = Mock(side_effect=lambda: Mock())
+	mine = connections_under_test.get('key', factory)
+	assert connections_under_test.get('key', factory) is mine
+	theirs = _in_thread(lambda: connections_under_test.get('key', factory))
+	assert theirs is not mine
+	# The finished thread's connection is handed to the next thread
+	assert _in_thread(lambda: connections_under_test.get('key', factory)) is \
+		theirs
+	assert factory.call_count == 2
+	connections_under_test.release()
+	assert connections_under_test.get('other', factory) is not mine
+	assert _in_thread(lambda: connections_under_test.get('key', factory)) in (
+		mine, theirs)
+	connections_under_test.clear()
+
+
+def test_idle_connections_are_capped():
+	connections_under_test.clear()
+	made = []
+	def factory():
+		made.append(Mock())
+		return made[-1]
+	with patch.object(connections_under_test, 'MAX_IDLE', 2):
+		barrier = threading.Event()
+		threads = [threading.Thread(target=lambda: (
+			connections_under_test.get('key', factory), barrier.wait()))
+			for _ in range(4)]
+		for thread in threads:
+			thread.start()
+		barrier.set()
+		for thread in threads:
+			thread.join()
+		connections_under_test.get('other', factory)
+	assert len(made) == 5
+	assert sum(conn.close.call_count for conn in made) == 2
+	assert len(connections_under_test._idle['key']) == 2
+	connections_under_test.clear()
+
+
+def test_pooled_keys_connections_by_arguments():
+	connections_under_test.clear()
+	def connect(creds, bucket_name=None):
+		return Mock()
+	pooled = connections_under_test.pooled('svc')(connect)
+	assert pooled.__name__ == 'connect'
+	assert pooled('creds') is pooled('creds')
+	assert pooled('creds') is not pooled('other')
+	by_format = connections_under_test.pooled('s3',
+		key=lambda creds, bucket_name=None: (creds, bucket_name == 'a.b'))(connect)
+	assert by_format('creds', bucket_name='x') is by_format('creds',
+		bucket_name='y')
+	assert by_format('creds', bucket_name='a.b') is not by_format('creds')
+	connections_under_test.clear()
@@ -0,0 +1,75 @@
+import io
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from mock import Mock, patch
+
+import k.aws.daemon as daemon_under_test
+
+SCRIPT = """
+import os, sys
+def main():
+	sys.stdout.write("args: %s\\n" % " ".join(sys.argv[1:]))
+	sys.stderr.write("env: %s\\n" % os.environ["K_AWS_DAEMON_TEST"])
+	sys.exit(3)
+"""
+
+
+def _serve(path):
+	server = threading.Thread(target=daemon_under_test.serve,
+		args=(path, 60, 0.5))
+	server.start()
+	for _ in range(100):
+		if os.path.exists(path):
+			break
+		time.sleep(0.01)
+	return server
+
+
+def test_request_runs_script_in_daemon_or_falls_back():
+	directory = tempfile.mkdtemp()
+	try:
+		path = os.path.join(directory, 'daemon.sock')
+		script = os.path.join(directory, 'tool')
+		with open(script, 'w') as writer:
+			writer.write(SCRIPT)
+		env = {'K_AWS_DAEMON_TEST': 'forwarded'}
+		stdout, stderr = io.BytesIO(), io.BytesIO()
+		assert daemon_under_test.request(path, script, [], stdout, stderr,
+			env=env) is None
+		server = _serve(path)
+		try:
+			assert daemon_under_test.request(path, script, ['a', 'b'], stdout,
+				stderr, env=env) == 3
+			assert stdout.getvalue() == b'args: a b\n'
+			assert stderr.getvalue() == b'env: forwarded\n'
+			assert 'K_AWS_DAEMON_TEST' not in os.environ
+			assert daemon_under_test.request(path, script + '-missing', [],
+				stdout, stderr, env=env) is None
+			assert daemon_under_test.request(path, script, [], stdout, stderr,
+				cwd=os.path.join(directory, 'missing'), env=env) is None
+			client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			client.connect(path)
+			client.sendall(b'{}\n')
+			assert client.recv(1) == b''
+			client.close()
+			assert daemon_under_test.request(path, script, [], stdout, stderr,
+				env=env) == 3
+		finally:
+			server.join()
+		assert not os.path.exists(path)
+	finally:
+		shutil.rmtree(directory)
+
+
+def test_cached_only_caches_in_daemon():
+	fetch = Mock(side_effect=[1, 2, 3])
+	assert daemon_under_test.cached('key', fetch) == 1
+	with patch.object(daemon_under_test, '_serving', True):
+		assert daemon_under_test.cached('key', fetch) == 2
+		assert daemon_under_test.cached('key', fetch) == 2
+	daemon_under_test._cache.clear()
@@ -0,0 +1,75 @@
+import threading
+import time
+from StringIO import StringIO
+
+import pytest
+from mock import patch
+
+import k.aws.fanout as fanout_under_test
+
+
+def test_across_regions_tags_results_and_collects_errors():
+	threads = set()
+	def list_things(region_creds):
+		threads.add(threading.current_thread().ident)
+		if region_creds.region_name == 'broken-1':
+			raise ValueError('no access')
+		return [region_creds.creds, region_creds.region_name]
+	results = fanout_under_test.across_regions(list_things, 'creds',
+		['us-east-1', 'broken-1', 'eu-west-1'])
+	items = []
+	with pytest.raises(fanout_under_test.FanoutError) as raised:
+		for item in fanout_under_test.merged(results):
+			items.append(item)
+	assert items == [('us-east-1', 'creds'), ('us-east-1', 'us-east-1'),
+		('eu-west-1', 'creds'), ('eu-west-1', 'eu-west-1')]
+	assert [tag for tag, _ in raised.value.errors] == ['broken-1']
+	assert threading.current_thread().ident not in threads
+
+
+def test_across_regions_defaults_to_every_region():
+	with patch.object(fanout_under_test, 'get_region_names',
+			return_value=['b', 'a']) as get_region_names:
+		results = list(fanout_under_test.across_regions(
+			lambda region_creds: [], 'creds', workers=1))
+	get_region_names.assert_called_once_with('creds')
+	assert [result.tag for result in results] == ['b', 'a']
+
+
+def test_across_environments_throttles_each_account():
+	lock = threading.Lock()
+	running, most = {}, {}
+	def list_things(region_creds):
+		env = region_creds.creds
+		with lock:
+			running[env] = running.get(env, 0) + 1
+			most[env] = max(most.get(env, 0), running[env])
+		time.sleep(0.02)
+		with lock:
+			running[env] -= 1
+		return [region_creds.region_name]
+	env_creds = [('prod', 'prod'), ('stage', 'stage'),
+		('broken', KeyError('broken'))]
+	with patch.object(fanout_under_test, 'get_environment_creds',
+			return_value=env_creds):
+		results = fanout_under_test.across_environments(list_things,
+			region_names=['r1', 'r2', 'r3'], workers=6, per_account=1)
+		output = StringIO()
+		assert not fanout_under_test.write_merged(results, stream=output)
+	assert most == {'prod': 1, 'stage': 1}
+	assert output.getvalue().splitlines() == [
+		'prod\tr1\tr1', 'stage\tr1\tr1', 'prod\tr2\tr2', 'stage\tr2\tr2',
+		'prod\tr3\tr3', 'stage\tr3\tr3']
+
+
+def test_environment_creds_never_fall_back_to_other_accounts():
+	def own_creds(env):
+		return 'creds-' + env if env == 'prod' else None
+	with patch('k.aws.config.get_creds_for_environment',
+			side_effect=own_creds), \
+			patch('k.aws.config.get_keys') as get_keys:
+		env_creds = fanout_under_test.get_environment_creds(['prod', 'stage'])
+	assert not get_keys.called
+	assert env_creds[0] == ('prod', 'creds-prod')
+	assert env_creds[1][0] == 'stage'
+	assert isinstance(env_creds[1][1], Exception)
@@ -0,0 +1,155 @@
+import gzip
+import imp
+import os
+import shutil
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(
+	os.path.abspath(__file__)))))
+respooler = imp.load_source('gzip_respooler',
+	os.path.join(ROOT, 'bin', 'gzip-respooler'))
+
+
+def _spools():
+	directory = tempfile.mkdtemp()
+	txt_spool = os.path.join(directory, 'txt')
+	os.mkdir(txt_spool)
+	respooler.create_spool_directories(os.path.join(directory, 'gz'))
+	return directory, txt_spool, os.path.join(directory, 'gz')
+
+
+def _spool_file(txt_spool, name, lines=100):
+	path = os.path.join(txt_spool, name)
+	with open(path, 'wb') as writer:
+		for line in range(lines):
+			writer.write(('%s line %d\n' % (name, line)).encode('ascii'))
+	with open(path, 'rb') as reader:
+		return path, reader.read()
+
+
+def _sent(gz_spool):
+	"""The decompressed contents of each file in the send dir, in order"""
+	send_dir = os.path.join(gz_spool, 'send')
+	contents = []
+	for name in sorted(os.listdir(send_dir), key=lambda name: float(name[:-3])):
+		with gzip.open(os.path.join(send_dir, name), 'rb') as reader:
+			contents.append(reader.read())
+	return contents
+
+
+def test_spool_files_are_streamed_into_one_file_in_every_flush_mode():
+	for flush in sorted(respooler.FLUSH_MODES):
+		directory, txt_spool, gz_spool = _spools()
+		try:
+			temp_spool = respooler.TempSpool(gz_spool, flush=flush)
+			files = [_spool_file(txt_spool, '%04d' % n) for n in range(3)]
+			for path, _ in files:
+				respooler.process_file(path, temp_spool, 1024 * 1024)
+			assert os.listdir(txt_spool) == []
+			temp_spool.complete()
+			assert _sent(gz_spool) == [b''.join(data for _, data in files)]
+		finally:
+			shutil.rmtree(directory)
+
+
+def test_salvage_drops_the_unfinished_spool_file():
+	for flush in sorted(respooler.FLUSH_MODES):
+		directory, txt_spool, gz_spool = _spools()
+		try:
+			temp_spool = respooler.TempSpool(gz_spool, flush=flush)
+			first, first_data = _spool_file(txt_spool, '0001')
+			second, _ = _spool_file(txt_spool, '0002')
+			respooler.process_file(first, temp_spool, 1024 * 1024)
+			# Dies part way through the second file, after some of its
+			# output has reached the temp spool
+			gz = temp_spool.compressor()
+			with open(second, 'rb') as reader:
+				gz.write(reader.read(500))
+			gz.flush()
+			temp_spool.fileobj.close()
+
+			respooler.TempSpool(gz_spool, flush=flush).salvage()
+			assert _sent(gz_spool) == [first_data]
+			assert os.path.exists(second)
+			assert os.listdir(os.path.join(gz_spool, 'temp')) == [
+				'gz_temp_spool.gz.offset']
+		finally:
+			shutil.rmtree(directory)
+
+
+def test_salvage_removes_a_spool_file_journaled_but_not_removed():
+	directory, txt_spool, gz_spool = _spools()
+	try:
+		temp_spool = respooler.TempSpool(gz_spool)
+		first, first_data = _spool_file(txt_spool, '0001')
+		temp_spool.write_file(first)
+		temp_spool.fileobj.close()
+
+		respooler.TempSpool(gz_spool).salvage()
+		assert not os.path.exists(first)
+		assert _sent(gz_spool) == [first_data]
+	finally:
+		shutil.rmtree(directory)
+
+
+def test_salvage_cut_short_is_picked_up_again():
+	directory, txt_spool, gz_spool = _spools()
+	try:
+		temp_spool = respooler.TempSpool(gz_spool)
+		first, first_data = _spool_file(txt_spool, '0001')
+		respooler.process_file(first, temp_spool, 1024 * 1024)
+		temp_spool.fileobj.close()
+		# Died after renaming the temp spool, while recompressing it
+		os.rename(temp_spool.path, temp_spool.damaged_path)
+		with open(temp_spool.salvaged_path, 'wb') as writer:
+			writer.write(b'partial')
+		respooler.TempSpool(gz_spool).salvage()
+		assert _sent(gz_spool) == [first_data]
+
+		# Died after removing the damaged file, before sending
+		writer = gzip.open(temp_spool.salvaged_path, 'wb')
+		writer.write(b'salvaged\n')
+		writer.close()
+		respooler.TempSpool(gz_spool).salvage()
+		assert _sent(gz_spool) == [first_data, b'salvaged\n']
+		assert not os.path.exists(temp_spool.salvaged_path)
+	finally:
+		shutil.rmtree(directory)
+
+
+class RecordingTempSpool(respooler.TempSpool):
+	"""Records which of the spool files still exist as each member is
+	appended"""
+	def __init__(self, gz_spool, paths):
+		respooler.TempSpool.__init__(self, gz_spool)
+		self.paths = paths
+		self.existing = []
+
+	def append_member(self, member):
+		self.existing.append([os.path.exists(path) for path in self.paths])
+		respooler.TempSpool.append_member(self, member)
+
+
+def test_parallel_compressor_writes_pieces_in_order_and_cuts_between_files():
+	directory, txt_spool, gz_spool = _spools()
+	try:
+		lines = respooler.PARALLEL_CHUNK_SIZE // len('0002 line 0\n')
+		files = [_spool_file(txt_spool, '0001'),
+			_spool_file(txt_spool, '0002', lines),
+			_spool_file(txt_spool, '0003')]
+		assert len(files[1][1]) > respooler.PARALLEL_CHUNK_SIZE
+		paths = [path for path, _ in files]
+		pieces = len(respooler.split_file(paths[1]))
+		temp_spool = RecordingTempSpool(gz_spool, paths)
+		compressor = respooler.ParallelCompressor(temp_spool, 3)
+		try:
+			compressor.process(paths, 1)
+		finally:
+			compressor.close()
+
+		assert _sent(gz_spool) == [data for _, data in files]
+		assert temp_spool.existing == [[True, True, True]] + \
+			[[False, True, True]] * pieces + [[False, False, True]]
+		assert os.listdir(txt_spool) == []
+	finally:
+		shutil.rmtree(directory)
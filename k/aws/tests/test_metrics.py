@@ -0,0 +1,85 @@
+import json
+import os
+import shutil
+import socket
+import tempfile
+
+from mock import patch
+
+import k.aws.metrics as metrics_under_test
+
+
+def _listener():
+	sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	sock.bind(('127.0.0.1', 0))
+	sock.settimeout(1)
+	return sock
+
+
+def _received(sock):
+	lines = []
+	sock.settimeout(0.2)
+	try:
+		while True:
+			lines.extend(sock.recv(65536).decode('utf-8').split('\n'))
+	except socket.timeout:
+		pass
+	return lines
+
+
+def test_percentile_is_nearest_rank():
+	samples = range(1, 101)
+	assert metrics_under_test.percentile(samples, 50) == 50
+	assert metrics_under_test.percentile(samples, 99) == 99
+	assert metrics_under_test.percentile([7], 90) == 7
+	assert metrics_under_test.percentile([], 90) == 0
+
+
+def test_flush_sends_statsd_and_writes_stats_file():
+	directory = tempfile.mkdtemp()
+	sock = _listener()
+	try:
+		spool = os.path.join(directory, 'spool')
+		os.mkdir(spool)
+		for name in ('a', 'b', '.journal'):
+			with open(os.path.join(spool, name), 'w') as writer:
+				writer.write('x' * 10)
+		stats_file = os.path.join(directory, 'stats.json')
+		metrics = metrics_under_test.Metrics('sender',
+			'127.0.0.1:%d' % sock.getsockname()[1], stats_file)
+		metrics.watch_backlog('backlog', spool)
+		metrics.incr('upload.bytes', 300)
+		metrics.incr('upload.retries')
+		for latency in range(1, 11):
+			metrics.timing('upload.part_latency', latency / 1000.0)
+		metrics.flush()
+		lines = _received(sock)
+		assert 'sender.upload.bytes:300|c' in lines
+		assert 'sender.upload.retries:1|c' in lines
+		assert 'sender.backlog.files:2|g' in lines
+		assert 'sender.backlog.bytes:20|g' in lines
+		assert len([line for line in lines if line.endswith('|ms')]) == 10
+		with open(stats_file) as reader:
+			stats = json.load(reader)
+		assert stats['counters']['upload.bytes']['total'] == 300
+		assert stats['timings']['upload.part_latency']['p50'] == 5.0
+		assert stats['timings']['upload.part_latency']['max'] == 10.0
+		metrics.incr('upload.bytes', 200)
+		metrics.close()
+		with open(stats_file) as reader:
+			stats = json.load(reader)
+		assert stats['counters']['upload.bytes']['count'] == 200
+		assert stats['counters']['upload.bytes']['total'] == 500
+	finally:
+		sock.close()
+		shutil.rmtree(directory)
+
+
+def test_disabled_flush_skips_backlog_scan():
+	metrics = metrics_under_test.Metrics('test')
+	metrics.watch_backlog('backlog', '/nonexistent')
+	metrics.incr('files')
+	with patch('k.aws.spool.backlog') as backlog:
+		metrics.flush()
+	assert not backlog.called
+	assert metrics.counters == {}
@@ -0,0 +1,66 @@
+from collections import namedtuple
+
+from mock import Mock, patch
+
+import k.aws.s3 as s3_under_test
+import k.aws.s3pattern
+from k.aws.tests.test_s3pattern import ListingBucket
+
+
+Grant = namedtuple('Grant', 'id uri permission')
+
+
+def _policy(owner, *grants):
+	policy = Mock()
+	policy.owner.id = owner
+	policy.acl.grants = [Grant(grantee if not grantee.startswith('http') else None,
+		grantee if grantee.startswith('http') else None, permission)
+		for grantee, permission in grants]
+	return policy
+
+
+def test_acl_matches_canned_acls():
+	public = _policy('me', ('me', 'FULL_CONTROL'), (s3_under_test.ALL_USERS, 'READ'))
+	assert s3_under_test.acl_matches(public, 'public-read')
+	assert not s3_under_test.acl_matches(public, 'private')
+	shared = _policy('me', ('me', 'FULL_CONTROL'), ('owner', 'FULL_CONTROL'))
+	assert s3_under_test.acl_matches(shared, 'bucket-owner-full-control', 'owner')
+	assert not s3_under_test.acl_matches(shared, 'bucket-owner-full-control')
+
+
+def test_parallel_set_acl_skips_matching_and_counts_failures():
+	bucket = Mock()
+	def get_acl(name):
+		if name == 'public':
+			return _policy('me', ('me', 'FULL_CONTROL'), (s3_under_test.ALL_USERS, 'READ'))
+		return _policy('me', ('me', 'FULL_CONTROL'))
+	def set_canned_acl(acl, name):
+		if name == 'broken':
+			raise ValueError(name)
+	bucket.get_acl.side_effect = get_acl
+	bucket.set_canned_acl.side_effect = set_canned_acl
+	conn = Mock()
+	conn.get_bucket.return_value = bucket
+	names = ['public', 'broken'] + ['key%d' % i for i in range(50)]
+	with patch.object(s3_under_test, 'connect', return_value=conn):
+		counts = s3_under_test.parallel_set_acl(None, 'bucket', names,
+			'public-read', threads=4, skip_matching=True, progress=False)
+	assert counts == {'set': 50, 'skipped': 1, 'failed': 1}
+
+
+class DeletingBucket(ListingBucket):
+	def delete_keys(self, names, quiet=False):
+		self.batches = getattr(self, 'batches', []) + [list(names)]
+		for name in names:
+			self.names.remove(name)
+		return Mock(errors=[])
+
+
+def test_delete_keys_deletes_only_the_names_matched():
+	bucket = DeletingBucket(['logs/a.gz', 'logs/a.gz.bak', 'logs/a.gz/x',
+		'logs/b.gz', 'logs/c.txt'], page_size=10)
+	pattern = k.aws.s3pattern.compile_glob('logs/*.gz')
+	names = [key.name for key in pattern.keys(bucket)]
+	assert s3_under_test.delete_keys(bucket, names, batch_size=1) == []
+	assert bucket.names == ['logs/a.gz.bak', 'logs/a.gz/x', 'logs/c.txt']
+	assert bucket.batches == [['logs/a.gz'], ['logs/b.gz']]
@@ -0,0 +1,164 @@
+from collections import namedtuple
+
+from boto.s3.prefix import Prefix
+from mock import Mock
+
+import k.aws.s3listing as listing_under_test
+
+
+FakeKey = namedtuple('FakeKey', 'name size etag last_modified storage_class')
+
+
+class FakeResultSet(list):
+	def __init__(self, items, is_truncated, next_marker=None):
+		list.__init__(self, items)
+		self.is_truncated = is_truncated
+		self.next_marker = next_marker
+
+
+def _in_boto_order(items, is_truncated):
+	"""A page, with its keys before its common prefixes, as boto's
+	ResultSet has them"""
+	keys = [item for item in items if not isinstance(item, Prefix)]
+	prefixes = [item for item in items if isinstance(item, Prefix)]
+	next_marker = items[-1].name if is_truncated else None
+	return FakeResultSet(keys + prefixes, is_truncated, next_marker)
+
+
+class FakeBucket(object):
+	"""Implements the subset of the s3 listing api used by k.aws.s3listing,
+	with small pages so that paging is exercised."""
+	def __init__(self, names, page_size=3):
+		self.names = sorted(names)
+		self.page_size = page_size
+		self.calls = 0
+
+	def get_all_keys(self, prefix='', marker='', delimiter='', max_keys=1000):
+		self.calls += 1
+		items = []
+		for name in self.names:
+			if not name.startswith(prefix) or name <= marker:
+				continue
+			rest = name[len(prefix):]
+			if delimiter and delimiter in rest:
+				common = prefix + rest[:rest.index(delimiter) + 1]
+				if name.startswith(marker) and marker.endswith(delimiter):
+					continue
+				if items and items[-1].name == common:
+					continue
+				items.append(Prefix(name=common))
+			else:
+				items.append(FakeKey(name, len(name), '"%s"' % name,
+					'2014-01-01T00:00:00.000Z', 'STANDARD'))
+			if len(items) == min(max_keys, self.page_size):
+				return _in_boto_order(items, True)
+		return _in_boto_order(items, False)
+
+
+NESTED = [
+	'a/', 'a/1', 'a/2', 'a/b/1', 'a/b/2', 'a/c/1',
+	'b', 'b/1', 'b/x/y/z', 'c/', 'c/1/2/3', 'd/9', 'top',
+] + ['logs/2014/%02d/%02d' % (m, d) for m in range(1, 4) for d in range(1, 6)]
+
+FLAT = ['%s%d' % (c, i) for c in 'AZaz09_-.' for i in range(4)] + ['~tilde']
+
+
+def _list(names, prefix='', threads=3, count=8, ordered=True):
+	bucket = FakeBucket(names)
+	shards = listing_under_test.plan_shards(bucket, prefix, count)
+	keys = listing_under_test.list_shards(
+		lambda: bucket, prefix, shards, threads, ordered)
+	return [key.name for key in keys]
+
+
+def _expected(names, prefix=''):
+	return sorted(name for name in names if name.startswith(prefix))
+
+
+def test_shards_are_disjoint_and_cover_everything():
+	boundaries = ['a', 'b', 'c', 'd', 'e']
+	shards = listing_under_test.shards_from_boundaries(boundaries, 3)
+	assert shards[0][0] is None
+	assert shards[-1][1] is None
+	for (_, end), (marker, _) in zip(shards[:-1], shards[1:]):
+		assert end == marker
+	assert len(shards) == 3
+
+
+def test_ordered_listing_matches_serial_listing():
+	assert _list(NESTED) == _expected(NESTED)
+	assert _list(NESTED, prefix='a/') == _expected(NESTED, 'a/')
+	assert _list(NESTED, prefix='logs/2014/') == _expected(NESTED, 'logs/2014/')
+
+
+def test_flat_keyspace_uses_character_ranges():
+	bucket = FakeBucket(FLAT)
+	boundaries = listing_under_test.discover_boundaries(bucket, '', 8)
+	assert boundaries == listing_under_test.FLAT_SPLIT_CHARS
+	assert _list(FLAT) == _expected(FLAT)
+
+
+def test_unordered_listing_yields_every_key_once():
+	names = _list(NESTED, ordered=False)
+	assert sorted(names) == _expected(NESTED)
+	assert len(names) == len(set(names))
+
+
+def test_single_shard():
+	assert _list(NESTED, count=1) == _expected(NESTED)
+
+
+def test_listing_errors_are_raised_in_the_reader():
+	bucket = FakeBucket(NESTED)
+	broken = Mock()
+	broken.get_all_keys.side_effect = ValueError("broken")
+	shards = listing_under_test.plan_shards(bucket, '', 4)
+	keys = listing_under_test.list_shards(lambda: broken, '', shards, 2)
+	try:
+		list(keys)
+	except ValueError:
+		pass
+	else:
+		raise AssertionError("the listing error was swallowed")
+
+
+def _keys(names, size=1):
+	return [FakeKey(name, size, '"%s"' % name[-1], None, 'STANDARD')
+		for name in names]
+
+
+def test_merge_listings_reports_only_differences():
+	src = _keys(['foo/a', 'foo/b', 'foo/c', 'foo/e'])
+	dst = _keys(['bar/b', 'bar/d']) + _keys(['bar/e'], size=2)
+	differences = listing_under_test.merge_listings(
+		listing_under_test.prefetch(iter(src)),
+		listing_under_test.prefetch(iter(dst)), 'foo/', 'bar/')
+	assert [(d.kind, d.name) for d in differences] == [
+		('missing', 'a'), ('missing', 'c'), ('extra', 'd'), ('mismatch', 'e')]
+
+
+def test_merge_listings_compares_etags_when_asked():
+	src = _keys(['a/x'])
+	dst = [FakeKey('b/x', 1, '"other"', None, 'STANDARD')]
+	assert list(listing_under_test.merge_listings(src, dst, 'a/', 'b/')) == []
+	differences = list(listing_under_test.merge_listings(
+		src, dst, 'a/', 'b/', compare_etag=True))
+	assert [d.kind for d in differences] == ['mismatch']
+
+
+def test_last_key_descends_instead_of_scanning():
+	names = NESTED + ['logs/2013/%02d/%02d' % (m, d)
+		for m in range(1, 13) for d in range(1, 29)]
+	bucket = FakeBucket(names)
+	assert listing_under_test.last_key(bucket, 'logs/').name == 'logs/2014/03/05'
+	assert bucket.calls < 8
+	assert listing_under_test.last_key(FakeBucket(FLAT), '').name == '~tilde'
+	assert listing_under_test.last_key(FakeBucket(NESTED), 'a/b').name == 'a/b/2'
+	assert listing_under_test.last_key(FakeBucket(NESTED), 'nope') is None
+
+
+def test_last_key_with_keys_after_the_last_common_prefix():
+	names = ['logs/2014/01/01', 'logs/2014/01/02', 'logs/zzz-manifest']
+	assert listing_under_test.last_key(FakeBucket(names), 'logs/').name == \
+		'logs/zzz-manifest'
+	assert listing_under_test.last_key(FakeBucket(NESTED), '').name == 'top'
@@ -0,0 +1,53 @@
+from k.aws.tests.test_s3listing import FakeBucket
+
+import k.aws.s3pattern as pattern_under_test
+
+
+class ListingBucket(FakeBucket):
+	def list(self, prefix=''):
+		self.prefixes = getattr(self, 'prefixes', []) + [prefix]
+		return [key for key in self.get_all_keys(prefix, max_keys=10000)]
+
+
+NAMES = ['logs/2014/%02d/%02d/%02d-%s' % (m, d, h, host)
+	for m in range(1, 7) for d in (1, 2) for h in (11, 12)
+	for host in ('web', 'db')] + ['logs/2013/01/01/12-web', 'other']
+
+
+def test_glob_prefixes_fan_out_over_classes_and_alternatives():
+	glob = pattern_under_test.compile_glob('logs/2014/0[1-3]/*/12-*')
+	assert glob.prefixes == ['logs/2014/01/', 'logs/2014/02/', 'logs/2014/03/']
+	glob = pattern_under_test.compile_glob('logs/{2013,2014/0{1,5}}/**')
+	assert glob.prefixes == ['logs/2013/', 'logs/2014/01/', 'logs/2014/05/']
+	assert pattern_under_test.compile_glob('*.gz').prefixes == ['']
+
+
+def test_regex_prefixes():
+	assert pattern_under_test.literal_prefixes(r'logs/201[34]/(01|02)/') == [
+		'logs/2013/01/', 'logs/2013/02/', 'logs/2014/01/', 'logs/2014/02/']
+	assert pattern_under_test.literal_prefixes(r'logs/\d+/') == ['logs/']
+	assert pattern_under_test.literal_prefixes(r'(?i)logs/') == ['']
+
+
+def test_overlapping_prefixes_are_listed_once():
+	assert pattern_under_test.minimize_prefixes(['a/b', 'a/', 'b', 'a/c']) == ['a/', 'b']
+
+
+def test_glob_matches_whole_names_and_star_stops_at_slash():
+	bucket = ListingBucket(NAMES, page_size=len(NAMES))
+	glob = pattern_under_test.compile_glob('logs/2014/0[1-3]/*/12-*')
+	names = [key.name for key in glob.keys(bucket)]
+	assert names == sorted(name for name in NAMES if name.startswith(
+		('logs/2014/01', 'logs/2014/02', 'logs/2014/03')) and '/12-' in name)
+	assert bucket.prefixes == glob.prefixes
+	assert not pattern_under_test.compile_glob('logs/*').match('logs/2014/01')
+	assert pattern_under_test.compile_glob('logs/**').match('logs/2014/01')
+
+
+def test_utf8_patterns_match_unicode_key_names():
+	glob = pattern_under_test.compile_glob(b'logs/caf\xc3\xa9/*')
+	assert glob.prefixes == [u'logs/caf\xe9/']
+	assert glob.match(u'logs/caf\xe9/1')
+	regex = pattern_under_test.compile_regex(b'logs/[e\xc3\xa9]/')
+	assert regex.prefixes == [u'logs/e/', u'logs/\xe9/']
+	assert regex.match(u'logs/\xe9/1')
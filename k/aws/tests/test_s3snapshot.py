@@ -0,0 +1,60 @@
+import time
+
+import k.aws.s3snapshot as snapshot_under_test
+from k.aws.tests.test_s3listing import FakeBucket, NESTED
+
+
+def _snapshot(tmpdir, names, prefix=''):
+	bucket = FakeBucket(names)
+	snapshot = snapshot_under_test.Snapshot(
+		'bucket', prefix, path=str(tmpdir.join('snapshot.db')))
+	return bucket, snapshot
+
+
+def test_refresh_lists_everything_once(tmpdir):
+	bucket, snapshot = _snapshot(tmpdir, NESTED)
+	assert snapshot.refresh(lambda: bucket, max_age=60, threads=3) > 0
+	assert [key.name for key in snapshot.keys()] == sorted(NESTED)
+
+	calls = bucket.calls
+	assert snapshot.refresh(lambda: bucket, max_age=60, threads=3) == 0
+	assert bucket.calls == calls
+
+
+def test_refresh_only_relists_stale_shards(tmpdir):
+	bucket, snapshot = _snapshot(tmpdir, NESTED)
+	snapshot.refresh(lambda: bucket, max_age=60, threads=3)
+	bucket.names = sorted(bucket.names + ['a/b/3', 'top2'])
+	bucket.names.remove('a/1')
+
+	# Age only the shard that holds the 'a/' keys.
+	stale = [shard for shard in snapshot.shards()
+		if snapshot_under_test.shard_overlaps_prefix(shard, 'a/b/')]
+	for shard in stale:
+		snapshot.db.execute("UPDATE shards SET refreshed = ? WHERE id = ?",
+			(time.time() - 3600, shard.id))
+	snapshot.db.commit()
+
+	assert snapshot.refresh(lambda: bucket, max_age=60, threads=3) == len(stale)
+	names = [key.name for key in snapshot.keys()]
+	assert 'a/b/3' in names
+	assert 'a/1' not in names
+	assert 'top2' not in names
+
+
+def test_queries(tmpdir):
+	bucket, snapshot = _snapshot(tmpdir, NESTED)
+	snapshot.refresh(lambda: bucket, max_age=60, threads=3)
+	assert [key.name for key in snapshot.keys(prefix='a/b')] == ['a/b/1', 'a/b/2']
+	assert [key.name for key in snapshot.keys(substring='/0')] == sorted(
+		name for name in NESTED if '/0' in name)
+	assert [key.name for key in snapshot.keys(max_size=1)] == ['b']
+	assert snapshot.summary(prefix='a/') == (6, sum(len(name)
+		for name in NESTED if name.startswith('a/')))
+	# LIKE wildcards in the substring are taken literally
+	assert list(snapshot.keys(substring='_')) == []
+
+
+def test_prefix_upper_bound():
+	assert snapshot_under_test.prefix_upper_bound('logs/') == 'logs0'
+	assert snapshot_under_test.prefix_upper_bound('') is None
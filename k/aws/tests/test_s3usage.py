@@ -0,0 +1,55 @@
+from k.aws.tests.test_s3listing import FakeKey
+
+import k.aws.s3usage as usage_under_test
+
+
+NOW = 1388534400 # 2014-01-01T00:00:00Z
+
+
+def _key(name, size, last_modified='2013-12-31T12:00:00.000Z', storage_class='STANDARD'):
+	return FakeKey(name, size, None, last_modified, storage_class)
+
+
+KEYS = [
+	_key('logs/2013/a', 1, '2013-01-01T00:00:00.000Z', 'GLACIER'),
+	_key('logs/2013/b', 2, '2013-12-20T00:00:00.000Z'),
+	_key('logs/2014/a', 4),
+	_key('logs/top', 8),
+	_key('other/x/y/z', 16, 'garbage'),
+]
+
+
+def test_rolls_up_by_prefix_storage_class_and_age():
+	usage = usage_under_test.Usage('', depth=2, now=NOW).add_all(KEYS)
+	assert usage.total == [5, 31]
+	assert usage.prefixes == {
+		'logs/': [4, 15], 'logs/2013/': [2, 3], 'logs/2014/': [1, 4],
+		'other/': [1, 16], 'other/x/': [1, 16]}
+	assert usage.storage_classes['GLACIER'] == [1, 1]
+	assert usage.storage_classes['STANDARD'] == [4, 30]
+	assert usage.ages['1 day'] == [2, 12]
+	assert usage.ages['30 days'] == [1, 2]
+	assert usage.ages['older'] == [1, 1]
+	assert usage.ages['unknown'] == [1, 16]
+
+
+def test_tree_is_depth_first_under_the_prefix():
+	usage = usage_under_test.Usage('logs/', depth=1, now=NOW)
+	usage.add_all(key for key in KEYS if key.name.startswith('logs/'))
+	assert list(usage.tree()) == [
+		(0, 'logs/', 4, 15), (1, 'logs/2013/', 2, 3), (1, 'logs/2014/', 1, 4)]
+
+
+def test_node_cap_bounds_memory():
+	usage = usage_under_test.Usage('', depth=2, max_nodes=2, now=NOW).add_all(KEYS)
+	assert len(usage.prefixes) == 2
+	assert usage.truncated
+	assert usage.total == [5, 31]
+
+
+def test_sampled_totals_are_scaled():
+	usage = usage_under_test.Usage('', depth=0, now=NOW).add_all(KEYS)
+	usage.scale = 4.0
+	summary = usage.as_dict()
+	assert summary['approximate']
+	assert (summary['count'], summary['size']) == (20, 124)
@@ -0,0 +1,70 @@
+import os
+import shutil
+import tempfile
+import threading
+
+import k.aws.spool as spool_under_test
+
+
+def _touch(directory, name):
+	with open(os.path.join(directory, name), 'w') as writer:
+		writer.write(name)
+
+
+def _drain(directory):
+	"""Yields every file written into directory, removing each, until 'stop'"""
+	seen = []
+	watch = spool_under_test.watch(directory, interval=0.01, tick=0.05)
+	for files in watch:
+		for path in files:
+			name = os.path.basename(path)
+			os.remove(path)
+			seen.append(name)
+		if 'stop' in seen:
+			watch.close()
+			return seen
+
+
+def test_list_spool_is_sorted():
+	directory = tempfile.mkdtemp()
+	try:
+		for name in ('b', 'c', 'a'):
+			_touch(directory, name)
+		assert spool_under_test.list_spool(directory) == [
+			os.path.join(directory, name) for name in ('a', 'b', 'c')]
+	finally:
+		shutil.rmtree(directory)
+
+
+def test_watch_sees_backlog_then_new_files():
+	directory = tempfile.mkdtemp()
+	try:
+		for index in range(5):
+			_touch(directory, '%03d' % index)
+		def writer():
+			for index in range(5, 10):
+				_touch(directory, '%03d' % index)
+			_touch(directory, 'stop')
+		timer = threading.Timer(0.2, writer)
+		timer.start()
+		seen = _drain(directory)
+		timer.join()
+		assert seen == ['%03d' % index for index in range(10)] + ['stop']
+	finally:
+		shutil.rmtree(directory)
+
+
+def test_inotify_watcher_wakes_on_close_write():
+	directory = tempfile.mkdtemp()
+	try:
+		try:
+			watcher = spool_under_test.InotifyWatcher(directory)
+		except OSError:
+			return
+		assert not watcher.wait(0.01)
+		_touch(directory, 'new')
+		assert watcher.wait(1)
+		assert not watcher.wait(0.01)
+		watcher.close()
+	finally:
+		shutil.rmtree(directory)
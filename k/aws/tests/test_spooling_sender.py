@@ -0,0 +1,334 @@
+import imp
+import os
+import shutil
+import tempfile
+from datetime import datetime
+
+import boto.exception
+import pytest
+from mock import Mock, patch
+
+from k.aws.tests.test_s3listing import FakeResultSet
+from k.aws.tests.test_s3pattern import ListingBucket
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(
+	os.path.abspath(__file__)))))
+sender = imp.load_source('s3_spooling_sender',
+	os.path.join(ROOT, 'bin', 's3-spooling-sender'))
+
+
+class Crash(Exception):
+	pass
+
+
+def _spool_file(directory, name):
+	path = os.path.join(directory, name)
+	with open(path, 'w') as writer:
+		writer.write(name)
+	return path
+
+
+def _journaled_state(spool_dir, pending, parts=None):
+	state = sender.Journal(spool_dir).load()
+	state['current_key'] = 'prefix/2014/01/01/00-machine-0.gz'
+	state['upload'] = {
+		'upload_id': 'upload-id',
+		'file_time': datetime(2014, 1, 1, 0),
+		'ordinal': 0,
+		'last_part_number': max(list(pending) + list(parts or {})),
+		'size': 0,
+		'parts': dict(parts or {}),
+		'pending': pending,
+	}
+	sender.save_state(state)
+	return state
+
+
+def _uploader(pending, on_ack):
+	uploader = sender.PartUploader.__new__(sender.PartUploader)
+	uploader.workers = 1
+	uploader.metrics = None
+	uploader.timeout = 1
+	uploader.retries = 0
+	uploader.on_ack = on_ack
+	uploader.on_give_up = None
+	uploader.on_lost = None
+	uploader.pending = pending
+	return uploader
+
+
+def test_crash_between_ack_and_removal_is_not_uploaded_again():
+	spool_dir = tempfile.mkdtemp()
+	try:
+		first = _spool_file(spool_dir, '0001')
+		second = _spool_file(spool_dir, '0002')
+		state = _journaled_state(spool_dir, {1: [first], 2: [second]})
+		task = (state['current_key'], 'upload-id', 1, [first], None)
+		result = Mock()
+		result.get.return_value = ('"etag"', 4, 0.1)
+
+		def crash(task, etag):
+			sender.acknowledge_part(state, task, etag)
+			raise Crash()
+
+		with pytest.raises(Crash):
+			_uploader([(result, task, 0)], crash).wait_one()
+		assert os.path.exists(first)
+
+		resumed = sender.Journal(spool_dir).load()
+		assert resumed['upload']['parts'] == {1: '"etag"'}
+		uploader = Mock()
+		sender.resume_upload(uploader, resumed, Mock(compress=False, level=6))
+
+		assert not os.path.exists(first)
+		assert os.path.exists(second)
+		uploader.submit.assert_called_once_with(resumed['current_key'],
+			'upload-id', 2, [second], None)
+		saved = sender.Journal(spool_dir).load()['upload']
+		assert saved['parts'] == {1: '"etag"'}
+		assert saved['pending'] == {2: [second]}
+	finally:
+		shutil.rmtree(spool_dir)
+
+
+def test_acknowledged_part_files_are_removed():
+	spool_dir = tempfile.mkdtemp()
+	try:
+		first = _spool_file(spool_dir, '0001')
+		state = _journaled_state(spool_dir, {1: [first]})
+		task = (state['current_key'], 'upload-id', 1, [first], None)
+		result = Mock()
+		result.get.return_value = ('"etag"', 4, 0.1)
+		existed = []
+
+		def acknowledged(task, etag):
+			existed.append(os.path.exists(first))
+			sender.acknowledge_part(state, task, etag)
+
+		_uploader([(result, task, 0)], acknowledged).wait_one()
+
+		assert existed == [True]
+		assert not os.path.exists(first)
+		assert state['upload']['parts'] == {1: '"etag"'}
+		assert state['upload']['pending'] == {}
+	finally:
+		shutil.rmtree(spool_dir)
+
+
+def test_timed_out_part_replaces_the_pool():
+	hung, done, running = Mock(), Mock(), Mock()
+	hung.get.side_effect = sender.TimeoutError()
+	done.ready.return_value = True
+	running.ready.return_value = False
+	tasks = [('key', 'upload-id', n, ['%04d' % n], None) for n in (1, 2, 3)]
+	uploader = _uploader([(hung, tasks[0], 0), (done, tasks[1], 0),
+		(running, tasks[2], 0)], None)
+	uploader.workers = 4
+	uploader.retries = 5
+	old_pool = uploader.pool = Mock()
+	uploader.pool_args = ('pool', 'args')
+	with patch.object(sender, 'Pool') as Pool:
+		uploader.wait_one()
+
+	old_pool.terminate.assert_called_once_with()
+	Pool.assert_called_once_with('pool', 'args')
+	new_pool = Pool.return_value
+	assert [args for args, _ in new_pool.apply_async.call_args_list] == [
+		(sender.upload_part, (tasks[2],)), (sender.upload_part, (tasks[0],))]
+	assert [(task, attempts) for _, task, attempts in uploader.pending] == [
+		(tasks[1], 0), (tasks[2], 0), (tasks[0], 1)]
+	assert uploader.pending[0][0] is done
+
+
+def _no_such_upload():
+	err = boto.exception.S3ResponseError(404, 'Not Found')
+	err.error_code = 'NoSuchUpload'
+	return err
+
+
+def test_crash_between_complete_and_journal_drops_the_upload():
+	spool_dir = tempfile.mkdtemp()
+	try:
+		new = _spool_file(spool_dir, '0002')
+		_journaled_state(spool_dir, {}, {1: '"etag"'})
+		# Restarted with the upload completed, but still journaled
+		resumed = sender.Journal(spool_dir).load()
+		sender.resume_upload(Mock(), resumed, Mock(compress=False, level=6))
+		assert resumed['upload'] is not None
+
+		# A part sent to it is lost rather than retried, and its file kept
+		task = (resumed['current_key'], 'upload-id', 2, [new], None)
+		result = Mock()
+		result.get.side_effect = sender.NoSuchUpload('upload-id')
+		uploader = _uploader([(result, task, 0)], None)
+		uploader.retries = 5
+		uploader.on_lost = lambda task: sender.drop_upload(resumed, task[1])
+		uploader.submit = Mock()
+		uploader.wait_one()
+		assert not uploader.submit.called
+		assert resumed['upload'] is None
+		assert os.path.exists(new)
+		assert sender.Journal(spool_dir).load()['upload'] is None
+	finally:
+		shutil.rmtree(spool_dir)
+
+
+def test_closing_an_upload_that_was_already_completed():
+	spool_dir = tempfile.mkdtemp()
+	try:
+		state = _journaled_state(spool_dir, {}, {1: '"etag"'})
+		bucket = Mock()
+		bucket.complete_multipart_upload.side_effect = _no_such_upload()
+		sender.close_finished_upload(bucket, state)
+		assert state['upload'] is None
+		assert sender.Journal(spool_dir).load()['upload'] is None
+	finally:
+		shutil.rmtree(spool_dir)
+
+
+HOUR = datetime(2014, 1, 1, 5)
+
+
+def _hour_keys(machine_id, ordinals):
+	info = sender.UploadInfo('bucket', 'logs', machine_id)
+	return [sender.gen_bucket_key_name(info, HOUR, ordinal)
+		for ordinal in ordinals]
+
+
+def test_next_ordinal_is_one_more_than_the_highest_listed():
+	info = sender.UploadInfo('bucket', 'logs', 'web1')
+	bucket = ListingBucket(_hour_keys('web1', [0, 3, 1]) +
+		_hour_keys('web10', [7]) + ['logs/2014/01/01/05-web1-x.gz'])
+	state = {'upload': None}
+	assert sender.next_ordinal(bucket, info, state, HOUR) == 4
+	assert bucket.prefixes == ['logs/2014/01/01/05-web1-']
+
+
+def test_next_ordinal_counts_the_upload_in_progress():
+	info = sender.UploadInfo('bucket', 'logs', 'web1')
+	bucket = ListingBucket(_hour_keys('web1', [0, 1]))
+	state = {'upload': {'file_time': HOUR, 'ordinal': 5}}
+	assert sender.next_ordinal(bucket, info, state, HOUR) == 6
+	# An upload from another hour doesn't count
+	state = {'upload': {'file_time': datetime(2014, 1, 1, 4), 'ordinal': 9}}
+	assert sender.next_ordinal(bucket, info, state, HOUR) == 2
+
+
+def test_next_ordinal_is_cached_for_the_hour():
+	info = sender.UploadInfo('bucket', 'logs', 'web1')
+	bucket = ListingBucket(_hour_keys('web1', [0]))
+	state = {'upload': None}
+	assert sender.next_ordinal(bucket, info, state, HOUR) == 1
+	assert sender.next_ordinal(bucket, info, state, HOUR) == 2
+	assert len(bucket.prefixes) == 1
+	next_hour = datetime(2014, 1, 1, 6)
+	assert sender.next_ordinal(bucket, info, state, next_hour) == 0
+	assert len(bucket.prefixes) == 2
+
+
+class AckingUploader(object):
+	"""Acknowledges every part as soon as it's submitted"""
+	def __init__(self, *args, **kwargs):
+		self.on_ack = kwargs.get('on_ack')
+		self.parts = []
+
+	def submit(self, bucket_key, upload_id, part_number, spool_files,
+			data=None):
+		self.parts.append((part_number, spool_files, data))
+		self.on_ack((bucket_key, upload_id, part_number, spool_files, data),
+			'"etag-%d"' % part_number)
+
+	def wait_all(self):
+		pass
+
+
+def _sender_bucket():
+	bucket = Mock()
+	bucket.list.return_value = []
+	bucket.get_all_multipart_uploads.return_value = FakeResultSet([], False)
+	bucket.initiate_multipart_upload.return_value = Mock(id='upload-id')
+	return bucket
+
+
+def _process(spool_dir, names, sizes, **options):
+	"""process_file() each of a list of spool files of the given sizes"""
+	options = Mock(**dict({'compress': False, 'level': 6, 'min_size': 100,
+		'max_upload_size': 0}, **options))
+	info = sender.UploadInfo('bucket', 'logs', 'web1')
+	bucket = _sender_bucket()
+	state = sender.Journal(spool_dir).load()
+	uploader = AckingUploader(
+		on_ack=lambda task, etag: sender.acknowledge_part(state, task, etag))
+	part_buffer = sender.PartBuffer(options.level, options.compress)
+	paths = []
+	for name, size in zip(names, sizes):
+		path = os.path.join(spool_dir, name)
+		with open(path, 'wb') as writer:
+			writer.write(b'x' * size)
+		paths.append(path)
+		sender.process_file(bucket, uploader, info, path, state, part_buffer,
+			options)
+	return paths, bucket, state, uploader, part_buffer
+
+
+def test_small_files_are_put_together_into_a_part_of_at_least_min():
+	spool_dir = tempfile.mkdtemp()
+	try:
+		paths, _, state, uploader, part_buffer = _process(spool_dir,
+			['0001', '0002', '0003', '0004'], [40, 40, 40, 10])
+		assert uploader.parts == [(1, paths[:3], b'x' * 120)]
+		assert part_buffer.files == paths[3:]
+		assert state['upload']['parts'] == {1: '"etag-1"'}
+	finally:
+		shutil.rmtree(spool_dir)
+
+
+def test_large_file_is_sent_directly_only_with_an_empty_buffer():
+	spool_dir = tempfile.mkdtemp()
+	try:
+		paths, _, _, uploader, _ = _process(spool_dir,
+			['0001', '0002', '0003'], [150, 10, 150])
+		assert uploader.parts == [(1, paths[:1], None),
+			(2, paths[1:], b'x' * 160)]
+	finally:
+		shutil.rmtree(spool_dir)
+
+
+def test_upload_is_closed_at_max_upload_size():
+	spool_dir = tempfile.mkdtemp()
+	try:
+		paths, bucket, state, uploader, _ = _process(spool_dir,
+			['0001', '0002', '0003'], [150, 150, 150], max_upload_size=300)
+		assert bucket.complete_multipart_upload.call_count == 1
+		assert bucket.initiate_multipart_upload.call_count == 2
+		# The third file is the first part of the next upload
+		assert [part[0] for part in uploader.parts] == [1, 2, 1]
+		assert state['upload']['parts'] == {1: '"etag-1"'}
+		assert state['upload']['size'] == 150
+	finally:
+		shutil.rmtree(spool_dir)
+
+
+def test_buffer_is_sent_as_the_last_part_when_idle():
+	spool_dir = tempfile.mkdtemp()
+	try:
+		spool_file = os.path.join(spool_dir, '0001')
+		with open(spool_file, 'wb') as writer:
+			writer.write(b'x' * 10)
+		bucket = _sender_bucket()
+		connection = Mock()
+		connection.get_bucket.return_value = bucket
+		options = Mock(compress=False, level=6, min_size=100,
+			max_upload_size=0, close_idle=0, sleep=0.01)
+		with patch.object(sender, 'PartUploader', AckingUploader), \
+				patch('k.aws.s3.connect', return_value=connection), \
+				patch('k.aws.metrics.get_metrics'), \
+				patch('k.aws.spool.watch', return_value=[[spool_file], []]):
+			sender.watch_directory('creds',
+				sender.UploadInfo('bucket', 'logs', 'web1'), spool_dir, options)
+		key, upload_id, xml = bucket.complete_multipart_upload.call_args[0]
+		assert upload_id == 'upload-id'
+		assert '<PartNumber>1</PartNumber><ETag>"etag-1"</ETag>' in xml
+		assert sender.Journal(spool_dir).load()['upload'] is None
+	finally:
+		shutil.rmtree(spool_dir)
@@ -0,0 +1,124 @@
+"""Startup time of the command line tools.
+
+Every python script in bin/ is imported (without running main()) in a
+fresh interpreter, and a few are run up to the point where they open
+their first connection, which is where the time is measured and the
+script is stopped.  The budgets, in seconds, can be changed with the
+K_AWS_IMPORT_BUDGET and K_AWS_FIRST_REQUEST_BUDGET environment variables,
+and the timings are written as json to K_AWS_STARTUP_REPORT if it is set.
+"""
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(
+	os.path.abspath(__file__)))))
+BIN = os.path.join(ROOT, 'bin')
+
+IMPORT_BUDGET = float(os.environ.get('K_AWS_IMPORT_BUDGET', 1.0))
+FIRST_REQUEST_BUDGET = float(os.environ.get('K_AWS_FIRST_REQUEST_BUDGET', 2.0))
+
+# Scripts run up to their first request, with the arguments to get there
+FIRST_REQUEST = {
+	's3-list': ['-b', 'k-aws-startup-test', 'prefix/'],
+	's3-get': ['-b', 'k-aws-startup-test', 'key'],
+	'ec2-list-tags': ['i-00000000'],
+	'rds-list': [],
+}
+
+# Run in the child: times the script from just after interpreter startup
+# until it has been imported (run_name isn't __main__) or until it opens
+# its first connection, which is refused by exiting
+HARNESS = r"""
+import os, runpy, socket, sys, time
+start = time.time()
+def connect(self, *args, **kwargs):
+	sys.stdout.write("first-request %f\n" % (time.time() - start))
+	sys.stdout.flush()
+	os._exit(0)
+socket.socket.connect = connect
+socket.socket.connect_ex = connect
+script, run_name = sys.argv[1], sys.argv[2]
+sys.argv = [script] + sys.argv[3:]
+runpy.run_path(script, run_name=run_name)
+sys.stdout.write("imported %f\n" % (time.time() - start))
+"""
+
+
+def _scripts():
+	for name in sorted(os.listdir(BIN)):
+		path = os.path.join(BIN, name)
+		with open(path) as reader:
+			if 'python' in reader.readline():
+				yield name, path
+
+
+def _time(path, run_name, args=()):
+	"""(event, seconds) of a script run under HARNESS, or (None, output)"""
+	home = tempfile.mkdtemp()
+	try:
+		existing = [entry for entry in
+			os.environ.get('PYTHONPATH', '').split(os.pathsep) if entry]
+		env = dict(os.environ, HOME=home, K_AWS_NO_DAEMON='1',
+			PYTHONPATH=os.pathsep.join([ROOT] + existing),
+			AWS_ACCESS_KEY_ID='AKIAK0AWS0STARTUP0TEST',
+			AWS_SECRET_ACCESS_KEY='k-aws-startup-test')
+		for name in ('AWS_ACCOUNT', 'AWS_CONFIG_FILE', 'AWS_CREDENTIAL_FILE'):
+			env.pop(name, None)
+		child = subprocess.Popen(
+			[sys.executable, '-c', HARNESS, path, run_name] + list(args),
+			stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+		output = child.communicate()[0].decode('utf-8', 'replace')
+	finally:
+		shutil.rmtree(home)
+	for line in output.splitlines():
+		parts = line.split()
+		if len(parts) == 2 and parts[0] in ('imported', 'first-request'):
+			return parts[0], float(parts[1])
+	return None, output
+
+
+def _report(section, timings):
+	path = os.environ.get('K_AWS_STARTUP_REPORT')
+	if not path:
+		return
+	report = {}
+	if os.path.exists(path):
+		with open(path) as reader:
+			report = json.load(reader)
+	report[section] = timings
+	with open(path, 'w') as writer:
+		json.dump(report, writer, indent=2, sort_keys=True)
+
+
+def test_scripts_import_within_budget():
+	timings, failures = {}, []
+	for name, path in _scripts():
+		event, result = _time(path, 'k_aws_startup')
+		if event is None:
+			failures.append("%s failed to import:\n%s" % (name, result))
+			continue
+		timings[name] = result
+		if result > IMPORT_BUDGET:
+			failures.append("%s took %.3fs to import (budget %.3fs)" % (
+				name, result, IMPORT_BUDGET))
+	_report('import', timings)
+	assert not failures, '\n'.join(failures)
+
+
+def test_first_request_within_budget():
+	timings, failures = {}, []
+	for name, args in sorted(FIRST_REQUEST.items()):
+		event, result = _time(os.path.join(BIN, name), '__main__', args)
+		if event != 'first-request':
+			failures.append("%s never made a request:\n%s" % (name, result))
+			continue
+		timings[name] = result
+		if result > FIRST_REQUEST_BUDGET:
+			failures.append("%s took %.3fs to its first request (budget %.3fs)" % (
+				name, result, FIRST_REQUEST_BUDGET))
+	_report('first-request', timings)
+	assert not failures, '\n'.join(failures)
@@ -2,6 +2,7 @@
 
 import yaml
 import json
+import os
 import re
 import urllib2
 import warnings
@@ -106,15 +107,15 @@ type_map = {
 	't1' : 'uI'
 }
 
-#: Conversion from the account id to the default key-pair name
-account_id_to_keypair_map = populate_account_id_to_keypair_map()
-
-def populate_account_id_to_keypair_map()
+def populate_account_id_to_keypair_map():
 	if os.path.exists(K_AWS_PATH + "/keypairs.yml"):
 		with open(K_AWS_PATH + "/keypairs.yml") as keys:
 			return yaml.load(keys)
 	return {}
 
+#: Conversion from the account id to the default key-pair name
+account_id_to_keypair_map = populate_account_id_to_keypair_map()
+
 def get_region_key(my_region):
 	"""
 	Returns the region key that should be used for the json data.
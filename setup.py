@@ -51,6 +51,7 @@ setup(
 		"bin/find-cfn-resource",
 		"bin/gzip-respooler",
 		"bin/iam-list-users",
+		"bin/k.aws-daemon",
 		"bin/k.aws-tool-link.sh",
 		"bin/rds-list",
 		"bin/s3-backup-schedule",